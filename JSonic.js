@@ -536,7 +536,7 @@ dojo.declare('uow.audio.JSonicCache', dijit._Widget, {
         return key;
     },
     
-    getSpeech: function(args, props) {
+    getSpeech: function(args, props, priority) {
         // get the client cache key
         var key = this._getSpeechCacheKey(args.text, props);
         args.key = key;
@@ -566,7 +566,8 @@ dojo.declare('uow.audio.JSonicCache', dijit._Widget, {
         var speechParams = {
             format : this._ext,
             utterances : {text : args.text},
-            properties: props
+            properties: props,
+            priority: priority || 'interactive'
         };
         resultDef = new dojo.Deferred();
         var request = {
@@ -685,7 +686,10 @@ dojo.declare('uow.audio.JSonicChannel', dijit._Widget, {
                     props[args.name] = args.value;
                 }
             });
-            args.audio = this.cache.getSpeech(args, props);
+            // speech that will not play next can yield to on-demand speech
+            var priority = (this._busy || this._queue.length) ? 
+                'prefetch' : 'interactive';
+            args.audio = this.cache.getSpeech(args, props, priority);
         } else if(args.method == '_getProperty') {
             args.defs.before.callback(this._properties[args.name]);
         }
@@ -0,0 +1,710 @@
+'''
+Speech file cache management for JSonic.
+
+:requires: Python 2.6, Tornado 1.0
+:copyright: Peter Parente 2010
+:license: BSD
+'''
+import tornado.ioloop
+import functools
+import errno
+import os
+
+# prefix of files still being written into the cache folder
+TEMP_PREFIX = 'tmp-'
+# number of hex characters of a filename used for each level of subfolders
+SHARD_WIDTH = 2
+# number of levels of subfolders
+SHARD_DEPTH = 2
+
+def get_path(path, name):
+    '''
+    Gets the path of a file in the cache folder. Files are spread across 
+    nested subfolders named after the leading characters of their names 
+    (e.g., ab/cd/abcdef...-0123...ogg) to keep every folder small.
+
+    :param path: Path to where synthesized files are stored
+    :type path: str
+    :param name: Filename relative to the cache folder
+    :type name: str
+    :return: Path of the file
+    :rtype: str
+    '''
+    parts = [name[i*SHARD_WIDTH:(i+1)*SHARD_WIDTH] for i in range(SHARD_DEPTH)]
+    return os.path.join(path, *(parts + [name]))
+
+def make_path(path, name):
+    '''
+    Gets the path of a file in the cache folder like get_path and creates its
+    subfolders if they do not exist yet.
+
+    :param path: Path to where synthesized files are stored
+    :type path: str
+    :param name: Filename relative to the cache folder
+    :type name: str
+    :return: Path of the file
+    :rtype: str
+    '''
+    fn = get_path(path, name)
+    try:
+        os.makedirs(os.path.dirname(fn))
+    except OSError, e:
+        # another process may have created it first
+        if e.errno != errno.EEXIST:
+            raise
+    return fn
+
+def find_path(path, name):
+    '''
+    Finds a file in the cache folder, looking in its subfolder first and then
+    at the top level where files live in caches not yet sharded by the 
+    reshard script.
+
+    :param path: Path to where synthesized files are stored
+    :type path: str
+    :param name: Filename relative to the cache folder
+    :type name: str
+    :return: Path of the file or None if it does not exist
+    :rtype: str
+    '''
+    for fn in (get_path(path, name), os.path.join(path, name)):
+        if os.path.isfile(fn):
+            return fn
+    return None
+
+def walk_files(path):
+    '''
+    Iterates over the names of all files in the cache folder and its 
+    subfolders.
+
+    :param path: Path to where synthesized files are stored
+    :type path: str
+    :return: Iterator over tuples of (folder path, filename)
+    :rtype: iterator
+    '''
+    for dirpath, dirnames, filenames in os.walk(path):
+        for name in filenames:
+            yield dirpath, name
+
+def get_temp_path(fn):
+    '''
+    Gets a unique path next to fn for writing a file before moving it into 
+    place with os.rename. Partially written files never match the FilesHandler
+    URL pattern or a CacheIndex lookup, so they cannot be served as complete.
+
+    :param fn: Final path of the file
+    :type fn: str
+    :return: Temporary path in the same folder
+    :rtype: str
+    '''
+    head, tail = os.path.split(fn)
+    return os.path.join(head, '%s%d-%s' % (TEMP_PREFIX, os.getpid(), tail))
+
+def get_temp_pid(name):
+    '''
+    Gets the ID of the process that wrote a temporary file named by
+    get_temp_path.
+
+    :param name: Name of the temporary file
+    :type name: str
+    :return: Process ID or None if the name is not of a temporary file
+    :rtype: int
+    '''
+    if not name.startswith(TEMP_PREFIX):
+        return None
+    try:
+        return int(name[len(TEMP_PREFIX):].split('-', 1)[0])
+    except ValueError:
+        return None
+
+def scan_folder(path, pids):
+    '''
+    Indexes the files in the cache folder and removes partially written files
+    left by processes that died while writing them in a single walk of the
+    folder. Meant to run in a background thread while the server answers
+    requests.
+
+    :param path: Path to where synthesized files are stored
+    :type path: str
+    :param pids: IDs of the processes that may still be writing files
+    :type pids: list
+    :return: New index of the files in the folder
+    :rtype: CacheIndex
+    '''
+    index = CacheIndex(path)
+    for dirpath, name in walk_files(path):
+        if name.startswith(TEMP_PREFIX):
+            if get_temp_pid(name) not in pids:
+                try:
+                    os.remove(os.path.join(dirpath, name))
+                except OSError:
+                    pass
+        elif '-' in get_root(name):
+            index.add(name)
+    return index
+
+def get_root(name):
+    '''
+    Gets the root name shared by all files synthesized from the same
+    utterance and properties, e.g. the WAV and all of its encodings.
+
+    :param name: Filename relative to the cache folder
+    :type name: str
+    :return: Filename up to its first extension
+    :rtype: str
+    '''
+    return name.split('.', 1)[0]
+
+class CacheIndex(object):
+    '''
+    In-memory index of the files in the speech cache folder. Lets the server
+    process answer synthesis requests for files that already exist without a
+    round trip through the worker pool.
+
+    The index starts out empty and is populated with an index of the folder
+    built by scan_folder in the background once the server listens. Until
+    then, files not in the index yet are looked up on disk. The index must be
+    kept up to date by the server process as workers finish writing new 
+    files. Files are grouped by root name and the groups are ordered from 
+    least to most recently used for eviction by a CacheManager. All methods
+    must be called on the IOLoop thread, except on an index that only the
+    calling thread knows about.
+
+    :ivar loaded: True once the index holds every file in the folder
+    :ivar _path: Cache folder path
+    :ivar _count: Number of files in the index
+    :ivar _bytes: Total size of the files of known size in the index
+    :ivar _unsized: Names of files in the index of unknown size
+    :ivar _groups: Root names paired with linked list nodes
+    :ivar _root: Sentinel node of the circular doubly linked list ordering
+        groups from least to most recently used. Nodes are lists of
+        [prev, next, root name, {filename : size or None}, pin count].
+    :ivar _evicting: Root names of groups being removed from disk paired with
+        callbacks to invoke once they are gone
+    '''
+    def __init__(self, path):
+        '''
+        Constructor.
+
+        :param path: Path to where synthesized files are stored
+        :type path: str
+        '''
+        self.loaded = False
+        self._path = path
+        self._count = 0
+        self._bytes = 0
+        self._unsized = set()
+        self._groups = {}
+        self._root = root = []
+        root[:] = [root, root, None, None, 0]
+        self._evicting = {}
+
+    def __contains__(self, name):
+        node = self._groups.get(get_root(name))
+        if node is not None and name in node[3]:
+            return True
+        if self.loaded or find_path(self._path, name) is None:
+            return False
+        self.add(name)
+        return True
+
+    def __len__(self):
+        return self._count
+
+    def add(self, name, size=None):
+        '''
+        Records that a file now exists in the cache folder and marks its group
+        as most recently used.
+
+        :param name: Filename relative to the cache folder
+        :type name: str
+        :param size: Size of the file in bytes or None if unknown
+        :type size: int
+        '''
+        root = get_root(name)
+        node = self._groups.get(root)
+        if node is None:
+            node = [None, None, root, {}, 0]
+            self._groups[root] = node
+        else:
+            self._unlink(node)
+        self._append(node)
+        if name in node[3]:
+            return
+        self._count += 1
+        node[3][name] = size
+        if size is None:
+            self._unsized.add(name)
+        else:
+            self._bytes += size
+
+    def update(self, scanned):
+        '''
+        Takes over the files of an index built by scan_folder and marks the
+        index as loaded. Files added and groups pinned since the scan started
+        are kept, their groups ahead of the scanned ones as most recently 
+        used.
+
+        :param scanned: Index of the cache folder no other thread uses
+        :type scanned: CacheIndex
+        '''
+        node = self._root[1]
+        while node is not self._root:
+            for name, size in node[3].iteritems():
+                scanned.add(name, size)
+                if size is not None:
+                    scanned.set_size(name, size)
+            for i in xrange(node[4]):
+                scanned.pin(node[2])
+            scanned.touch(node[2])
+            node = node[1]
+        self._count = scanned._count
+        self._bytes = scanned._bytes
+        self._unsized = scanned._unsized
+        self._groups = scanned._groups
+        self._root = scanned._root
+        self.loaded = True
+
+    def discard(self, name):
+        '''
+        Records that a file no longer exists in the cache folder.
+
+        :param name: Filename relative to the cache folder
+        :type name: str
+        '''
+        root = get_root(name)
+        node = self._groups.get(root)
+        if node is None or name not in node[3]:
+            return
+        size = node[3].pop(name)
+        self._count -= 1
+        if size is None:
+            self._unsized.discard(name)
+        else:
+            self._bytes -= size
+        if not node[3] and not node[4]:
+            self._unlink(node)
+            del self._groups[root]
+
+    def touch(self, name):
+        '''
+        Marks the group of a file as most recently used.
+
+        :param name: Filename relative to the cache folder
+        :type name: str
+        '''
+        node = self._groups.get(get_root(name))
+        if node is not None:
+            self._unlink(node)
+            self._append(node)
+
+    def pin(self, name):
+        '''
+        Protects the group of a file from eviction while it is being encoded
+        or served. Every call must be balanced by a call to unpin.
+
+        :param name: Filename relative to the cache folder
+        :type name: str
+        '''
+        root = get_root(name)
+        node = self._groups.get(root)
+        if node is None:
+            # pin files that are not written yet too
+            node = [None, None, root, {}, 0]
+            self._groups[root] = node
+            self._append(node)
+        node[4] += 1
+
+    def unpin(self, name):
+        '''
+        Removes one pin placed on the group of a file by pin.
+
+        :param name: Filename relative to the cache folder
+        :type name: str
+        '''
+        root = get_root(name)
+        node = self._groups[root]
+        node[4] -= 1
+        if not node[3] and not node[4]:
+            self._unlink(node)
+            del self._groups[root]
+
+    def is_evicting(self, name):
+        '''
+        :param name: Filename relative to the cache folder
+        :type name: str
+        :return: True if the group of the file is being removed from disk and
+            must not be written again until after_eviction callbacks run
+        :rtype: bool
+        '''
+        return get_root(name) in self._evicting
+
+    def after_eviction(self, name, callback):
+        '''
+        Invokes a callback once the group of a file being evicted is gone 
+        from disk.
+
+        :param name: Filename relative to the cache folder
+        :type name: str
+        :param callback: Callable taking no arguments
+        :type callback: callable
+        '''
+        self._evicting[get_root(name)].append(callback)
+
+    def get_unsized(self):
+        '''
+        :return: Names of files whose size is not known yet
+        :rtype: list
+        '''
+        return list(self._unsized)
+
+    def set_size(self, name, size):
+        '''
+        Records the size of a file already in the index.
+
+        :param name: Filename relative to the cache folder
+        :type name: str
+        :param size: Size of the file in bytes
+        :type size: int
+        '''
+        node = self._groups.get(get_root(name))
+        if node is not None and node[3].get(name, 0) is None:
+            node[3][name] = size
+            self._unsized.discard(name)
+            self._bytes += size
+
+    def get_size(self):
+        '''
+        :return: Total size in bytes of all files of known size
+        :rtype: int
+        '''
+        return self._bytes
+
+    def start_eviction(self, maxBytes, maxFiles):
+        '''
+        Picks least recently used, unpinned groups to evict until the index
+        fits the given budget. Removes the picked files from the index and 
+        marks their groups as evicting until finish_eviction is called.
+
+        :param maxBytes: Byte budget or zero for no limit
+        :type maxBytes: int
+        :param maxFiles: File count budget or zero for no limit
+        :type maxFiles: int
+        :return: Names of the files to remove from disk
+        :rtype: list
+        '''
+        size = self._bytes
+        victims = []
+        node = self._root[1]
+        while node is not self._root:
+            if not ((maxBytes and size > maxBytes) or 
+            (maxFiles and self._count > maxFiles)):
+                break
+            next = node[1]
+            if not node[4] and node[2] not in self._evicting:
+                self._evicting[node[2]] = []
+                for name, fsize in node[3].items():
+                    size -= fsize or 0
+                    victims.append(name)
+                    self.discard(name)
+            node = next
+        return victims
+
+    def finish_eviction(self, names):
+        '''
+        Marks the groups of evicted files as gone from disk and invokes any
+        callbacks waiting on them.
+
+        :param names: Names of the files removed from disk
+        :type names: list
+        '''
+        for root in set([get_root(name) for name in names]):
+            for callback in self._evicting.pop(root, []):
+                callback()
+
+    def _append(self, node):
+        root = self._root
+        last = root[0]
+        node[0] = last
+        node[1] = root
+        last[1] = root[0] = node
+
+    def _unlink(self, node):
+        prev, next = node[0], node[1]
+        prev[1] = next
+        next[0] = prev
+
+def stat_files(path, names):
+    '''
+    Gets the sizes of files in the cache folder. Meant to run in the I/O 
+    thread pool.
+
+    :param path: Path to where synthesized files are stored
+    :type path: str
+    :param names: Filenames relative to the cache folder
+    :type names: list
+    :return: Filenames paired with their sizes, None for files that are gone
+    :rtype: dict
+    '''
+    sizes = {}
+    for name in names:
+        fn = find_path(path, name)
+        try:
+            sizes[name] = fn and os.path.getsize(fn)
+        except OSError:
+            sizes[name] = None
+    return sizes
+
+def remove_files(path, names):
+    '''
+    Removes files from the cache folder. Meant to run in the I/O thread pool.
+
+    :param path: Path to where synthesized files are stored
+    :type path: str
+    :param names: Filenames relative to the cache folder
+    :type names: list
+    :return: names
+    :rtype: list
+    '''
+    for name in names:
+        for fn in (get_path(path, name), os.path.join(path, name)):
+            try:
+                os.remove(fn)
+            except OSError:
+                pass
+    return names
+
+class CacheManager(object):
+    '''
+    Sizes files new to the cache folder and optionally moves small ones into
+    a pack store. Keeps the cache within a byte and file count budget by
+    periodically evicting the least recently used files along with all other
+    files sharing their root name (e.g., an encoding and its WAV). Disk access
+    happens in the I/O thread pool so eviction never blocks requests.
+
+    :ivar _path: Cache folder path
+    :ivar _index: CacheIndex of the folder
+    :ivar _ioPool: Thread pool for disk access
+    :ivar _memoryCache: MemoryCache to purge of evicted files
+    :ivar _packStore: pack.PackStore to move small files into or None
+    :ivar maxBytes: Byte budget or zero for no limit
+    :ivar maxFiles: File count budget or zero for no limit
+    :ivar evicted: Number of files evicted so far
+    :ivar _busy: True while an eviction pass is in progress
+    :cvar INTERVAL: Milliseconds between eviction passes
+    '''
+    INTERVAL = 10000
+
+    def __init__(self, path, index, ioPool, memoryCache, maxBytes, maxFiles,
+    packStore=None):
+        '''
+        Constructor.
+
+        :param path: Path to where synthesized files are stored
+        :type path: str
+        :param index: Index of the cache folder
+        :type index: CacheIndex
+        :param ioPool: Thread pool for disk access
+        :type ioPool: multiprocessing.pool.ThreadPool
+        :param memoryCache: In-memory cache of file contents
+        :type memoryCache: MemoryCache
+        :param maxBytes: Byte budget or zero for no limit
+        :type maxBytes: int
+        :param maxFiles: File count budget or zero for no limit
+        :type maxFiles: int
+        :param packStore: Store to move small encoded files into or None to
+            keep all files loose
+        :type packStore: pack.PackStore
+        '''
+        self._path = path
+        self._index = index
+        self._ioPool = ioPool
+        self._memoryCache = memoryCache
+        self._packStore = packStore
+        self.maxBytes = maxBytes
+        self.maxFiles = maxFiles
+        self.evicted = 0
+        self._busy = False
+
+    def start(self):
+        '''
+        Starts periodic passes on the IOLoop that size new files and evict old
+        ones if there is a budget.
+        '''
+        tornado.ioloop.PeriodicCallback(self.evict, self.INTERVAL).start()
+
+    def evict(self):
+        '''
+        Starts an eviction pass unless one is already running or the index
+        is not loaded yet.
+        '''
+        if self._busy or not self._index.loaded:
+            return
+        self._busy = True
+        names = self._index.get_unsized()
+        if names:
+            # learn the sizes of new files before deciding what to evict
+            self._ioPool.apply_async(stat_files, (self._path, names), 
+                callback=self._in_loop(self._on_sized))
+        else:
+            self._on_sized({})
+
+    def get_stats(self):
+        '''
+        :return: Counters describing the cache folder
+        :rtype: dict
+        '''
+        return {
+            'files' : len(self._index),
+            'bytes' : self._index.get_size(),
+            'evicted' : self.evicted,
+            'max_bytes' : self.maxBytes,
+            'max_files' : self.maxFiles
+        }
+
+    def _in_loop(self, callback):
+        # wrap a pool callback to run on the IOLoop thread
+        loop = tornado.ioloop.IOLoop.instance()
+        return lambda result: loop.add_callback(
+            functools.partial(callback, result))
+
+    def _on_sized(self, sizes):
+        for name, size in sizes.iteritems():
+            if size is None:
+                self._index.discard(name)
+            else:
+                self._index.set_size(name, size)
+        if self._packStore is not None:
+            # move new small encodings into the pack
+            self._packStore.add([name for name, size in sizes.iteritems()
+                if size is not None and size <= self._packStore.maxItemBytes
+                and not name.endswith('.wav')])
+        victims = self._index.start_eviction(self.maxBytes, self.maxFiles)
+        if not victims:
+            self._busy = False
+            return
+        for name in victims:
+            self._memoryCache.discard(name)
+        if self._packStore is not None:
+            self._packStore.remove(victims)
+        self._ioPool.apply_async(remove_files, (self._path, victims), 
+            callback=self._in_loop(self._on_removed))
+
+    def _on_removed(self, names):
+        self.evicted += len(names)
+        self._index.finish_eviction(names)
+        self._busy = False
+
+class MemoryCache(object):
+    '''
+    Size-bounded in-memory cache with least recently used eviction. Holds the
+    bytes of small, frequently requested speech files so they can be served
+    without touching the disk.
+
+    :ivar maxBytes: Byte budget for all cached values
+    :ivar maxItemBytes: Largest value accepted into the cache
+    :ivar hits: Number of successful lookups
+    :ivar misses: Number of failed lookups
+    :ivar _size: Bytes currently cached
+    :ivar _map: Keys paired with linked list nodes
+    :ivar _root: Sentinel node of the circular doubly linked list ordering
+        nodes from least to most recently used. Nodes are lists of
+        [prev, next, key, value, size].
+    '''
+    def __init__(self, maxBytes, maxItemBytes):
+        '''
+        Constructor.
+
+        :param maxBytes: Byte budget for all cached values, zero to disable
+            caching
+        :type maxBytes: int
+        :param maxItemBytes: Largest value accepted into the cache
+        :type maxItemBytes: int
+        '''
+        self.maxBytes = maxBytes
+        self.maxItemBytes = min(maxItemBytes, maxBytes)
+        self.hits = 0
+        self.misses = 0
+        self._size = 0
+        self._map = {}
+        self._root = root = []
+        root[:] = [root, root, None, None, 0]
+
+    def __len__(self):
+        return len(self._map)
+
+    def get(self, key):
+        '''
+        Gets a cached value and marks it as most recently used.
+
+        :param key: Key of the value
+        :type key: str
+        :return: Cached value or None if it is not cached
+        '''
+        node = self._map.get(key)
+        if node is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._unlink(node)
+        self._append(node)
+        return node[3]
+
+    def put(self, key, value, size):
+        '''
+        Caches a value, evicting the least recently used values until the 
+        cache fits its byte budget. Values larger than maxItemBytes are 
+        ignored.
+
+        :param key: Key of the value
+        :type key: str
+        :param value: Value to cache
+        :param size: Size of the value in bytes
+        :type size: int
+        '''
+        if size > self.maxItemBytes:
+            return
+        self.discard(key)
+        while self._size + size > self.maxBytes:
+            self.discard(self._root[1][2])
+        node = [None, None, key, value, size]
+        self._append(node)
+        self._map[key] = node
+        self._size += size
+
+    def discard(self, key):
+        '''
+        Removes a value from the cache if it is present.
+
+        :param key: Key of the value
+        :type key: str
+        '''
+        node = self._map.pop(key, None)
+        if node is not None:
+            self._unlink(node)
+            self._size -= node[4]
+
+    def get_stats(self):
+        '''
+        :return: Counters describing the effectiveness of the cache
+        :rtype: dict
+        '''
+        return {
+            'hits' : self.hits,
+            'misses' : self.misses,
+            'entries' : len(self._map),
+            'bytes' : self._size,
+            'max_bytes' : self.maxBytes
+        }
+
+    def _append(self, node):
+        root = self._root
+        last = root[0]
+        node[0] = last
+        node[1] = root
+        last[1] = root[0] = node
+
+    def _unlink(self, node):
+        prev, next = node[0], node[1]
+        prev[1] = next
+        next[0] = prev
@@ -0,0 +1,154 @@
+'''
+Catalog of the properties supported by the available speech engines,
+computed once and persisted next to the speech file cache.
+
+:requires: Python 2.6, Tornado 1.1
+:copyright: Peter Parente 2010
+:license: BSD
+'''
+import cache
+from tornado.escape import json_encode, json_decode
+import hashlib
+import logging
+import os
+
+# name of the persisted catalog in the cache folder, never mistaken for a
+# speech file because it has no dash
+CATALOG_NAME = 'engines.json'
+
+class EngineCatalog(object):
+    '''
+    Holds the ISynthesizer.get_info result of every available engine along
+    with the encoded /engine responses. Info is loaded from disk when the
+    engine fingerprint matches the one stored with it and computed otherwise.
+    Workers load the persisted catalog too so that they validate properties
+    without querying the engine themselves.
+
+    :ivar _fn: Path of the persisted catalog
+    :ivar _stored: Engine names paired with the entries read from disk
+    :ivar _classes: Engine names paired with ISynthesizer implementations
+    :ivar _entries: Engine names paired with dicts holding the fingerprint
+        and info of the engine
+    :ivar _responses: Engine names, or None for the engine list, paired with
+        tuples of (JSON body, ETag) ready to send
+    '''
+    def __init__(self, path):
+        '''
+        Constructor. Reads the persisted catalog.
+
+        :param path: Path to where synthesized files are stored
+        :type path: str
+        '''
+        self._fn = os.path.join(path, CATALOG_NAME)
+        try:
+            fh = open(self._fn, 'rb')
+            try:
+                self._stored = json_decode(fh.read())
+            finally:
+                fh.close()
+        except (IOError, ValueError):
+            self._stored = {}
+        self._classes = {}
+        self._entries = {}
+        self._responses = {}
+
+    def get_fingerprints(self):
+        '''
+        :return: Engine names paired with the fingerprints they had when they
+            were last queried successfully
+        :rtype: dict
+        '''
+        return dict((name, entry.get('fingerprint')) 
+            for name, entry in self._stored.items())
+
+    def load(self, classes):
+        '''
+        Installs the persisted info of engines whose fingerprints still match.
+
+        :param classes: Engine names paired with ISynthesizer implementations
+        :type classes: dict
+        :return: Names of the engines that need build
+        :rtype: list
+        '''
+        self._classes = classes
+        missing = []
+        for name, cls in self._classes.items():
+            entry = self._stored.get(name)
+            fingerprint = cls.get_fingerprint()
+            if (fingerprint is not None and entry is not None and
+            entry.get('fingerprint') == fingerprint):
+                self._install(name, entry)
+            else:
+                missing.append(name)
+        self._update_list()
+        return missing
+
+    def build(self, names=None):
+        '''
+        Queries engines for their info, installs it, and persists the catalog.
+        Querying may run engine commands so this must not run on the IOLoop
+        thread.
+
+        :param names: Names of the engines to query or None for all engines
+            that are not in the catalog
+        :type names: list
+        '''
+        if names is None:
+            names = [name for name in self._classes
+                if name not in self._entries]
+        for name in names:
+            cls = self._classes[name]
+            try:
+                entry = {
+                    'fingerprint' : cls.get_fingerprint(),
+                    'info' : cls.get_info()
+                }
+            except Exception:
+                logging.warning('Could not get info for engine "%s"', name,
+                    exc_info=True)
+                continue
+            self._install(name, entry)
+        self._update_list()
+        self._save()
+
+    def get_response(self, name=None):
+        '''
+        Gets the /engine response for an engine.
+
+        :param name: Name of the engine or None for the list of engines
+        :type name: str
+        :return: Tuple of (JSON body, ETag) or None if the engine is unknown
+            or its info is unavailable
+        :rtype: tuple
+        '''
+        return self._responses.get(name)
+
+    def _install(self, name, entry):
+        cls = self._classes[name]
+        cls.INFO = entry['info']
+        cls.VOICES = None
+        self._entries[name] = entry
+        self._responses[name] = self._encode(entry['info'])
+
+    def _update_list(self):
+        self._responses[None] = self._encode(self._classes.keys())
+
+    def _encode(self, result):
+        body = json_encode({'success' : True, 'result' : result})
+        return body, '"%s"' % hashlib.sha1(body).hexdigest()
+
+    def _save(self):
+        # only persist engines that can tell when they change
+        stored = dict((name, entry) for name, entry in self._entries.items()
+            if entry['fingerprint'] is not None)
+        tmp = cache.get_temp_path(self._fn)
+        try:
+            fh = open(tmp, 'wb')
+            try:
+                fh.write(json_encode(stored))
+            finally:
+                fh.close()
+            os.rename(tmp, self._fn)
+        except (IOError, OSError):
+            logging.warning('Could not write the engine catalog',
+                exc_info=True)
@@ -4,12 +4,21 @@ Audio encoder implementations for JSonic.
 :var ENCODERS: Names paired with available IEncoder implementations
 :type ENCODERS: dict
 
-:requires: Python 2.6, iterpipes 0.3, lame 3.98.2, oggenc 1.2.0
+:requires: Python 2.6, iterpipes 0.3, lame 3.98.2, oggenc 1.2.0, optionally
+    libsndfile 1.0.18 (1.1.0 for MP3), opusenc 0.1.9, ffmpeg with libopus
 :copyright: Peter Parente 2010
 :license: BSD
 '''
 import iterpipes
+import cache
+import ctypes
+import ctypes.util
 import os
+import shutil
+import StringIO
+import subprocess
+import threading
+import wave
 
 class EncoderError(Exception):
     '''
@@ -21,13 +30,25 @@ class EncoderError(Exception):
 class IEncoder(object):
     '''
     All synthesizers must implement this instance interface.
+    
+    :cvar PROFILES: Names of the quality profiles supported by the encoder
+        paired with their encoder settings, empty if the encoder has none
+    :cvar JOINABLE: True if files in the format can be concatenated into one
+        file that plays all of them in order
     '''
-    def __init__(self, path):
+    PROFILES = {}
+    JOINABLE = True
+
+    def __init__(self, path, profile=None):
         '''
         Constructor.
         
         :param path: Path to where synthesized files are stored
         :type path: str
+        :param profile: Name of one of the PROFILES to encode with or None
+            for the default quality. Encoded files are named 
+            <root>.<profile><extension> when a profile is given.
+        :type profile: str
         :raises: EncoderError
         '''
         raise NotImplementedError
@@ -45,41 +66,454 @@ class IEncoder(object):
         '''
         raise NotImplementedError
 
+    def encode_stream(self, hashFn, writer):
+        '''
+        Encodes WAV data produced by writer to a file in the cache folder
+        without reading it from a WAV file on disk. The encoded file is named 
+        just like encode_wav names it.
+        
+        :param hashFn: Root name of the encoded file, sans extension
+        :type hashFn: str
+        :param writer: Callable that writes the WAV data to the file object
+            passed to it, typically ISynthesizer.stream_wav with the utterance
+            bound
+        :type writer: callable
+        :raises: EncoderError
+        '''
+        raise NotImplementedError
+
+    def get_encode_command(self):
+        '''
+        Gets a command line that reads WAV data from stdin and writes the
+        encoded audio to stdout. Used to run the encoder as a child of the
+        server process without blocking it.
+        
+        :return: Command line arguments
+        :rtype: list
+        '''
+        raise NotImplementedError
+
+def _pipe_into_place(args, writer, tmp, fn, name):
+    '''
+    Runs an encoder process reading WAV data from stdin as written by writer
+    and moves its output file into place when it succeeds.
+
+    :param args: Encoder command line writing to stdout
+    :type args: list
+    :param writer: Callable that writes WAV data to the file object passed
+    :type writer: callable
+    :param tmp: Temporary output path of the encoder process
+    :type tmp: str
+    :param fn: Final path of the encoded file
+    :type fn: str
+    :param name: Name of the encoder for error reporting
+    :type name: str
+    :raises: EncoderError
+    '''
+    out = open(tmp, 'wb')
+    try:
+        p = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=out)
+    except:
+        out.close()
+        os.remove(tmp)
+        raise
+    out.close()
+    try:
+        writer(p.stdin)
+    except:
+        p.kill()
+        p.wait()
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+    p.stdin.close()
+    _move_into_place(p.wait(), tmp, fn, name)
+
+def _move_into_place(ret, tmp, fn, name):
+    '''
+    Atomically replaces fn with the temporary file written by an encoder 
+    process if the process succeeded. Removes the temporary file otherwise.
+    
+    :param ret: Exit code of the encoder process
+    :type ret: int
+    :param tmp: Temporary output path of the encoder process
+    :type tmp: str
+    :param fn: Final path of the encoded file
+    :type fn: str
+    :param name: Name of the encoder for error reporting
+    :type name: str
+    :raises: EncoderError
+    '''
+    if ret == 0:
+        os.rename(tmp, fn)
+        return
+    try:
+        os.remove(tmp)
+    except OSError:
+        pass
+    raise EncoderError('%s failed with exit code %s' % (name, ret))
+
 class OggEncoder(IEncoder):
     '''
     Encodes audio using Ogg Vorbis from the command line.
     '''
-    def __init__(self, path):
+    def __init__(self, path, profile=None):
         '''Implements IEncoder constructor.'''
         self._path = path
 
     def encode_wav(self, hashFn):
         '''Implements IEncoder.encode_wav.'''
-        wav = os.path.join(self._path, hashFn+'.wav')
-        ogg = os.path.join(self._path, hashFn+'.ogg')
+        wav = cache.get_path(self._path, hashFn+'.wav')
+        ogg = cache.make_path(self._path, hashFn+'.ogg')
         if not os.path.isfile(ogg):
-            c = iterpipes.cmd('oggenc --quiet {} -o {}', wav, ogg)
+            tmp = cache.get_temp_path(ogg)
+            c = iterpipes.cmd('oggenc --quiet {} -o {}', wav, tmp)
             ret = iterpipes.call(c)
+            _move_into_place(ret, tmp, ogg, 'oggenc')
+
+    def encode_stream(self, hashFn, writer):
+        '''Implements IEncoder.encode_stream.'''
+        ogg = cache.make_path(self._path, hashFn+'.ogg')
+        if not os.path.isfile(ogg):
+            tmp = cache.get_temp_path(ogg)
+            _pipe_into_place(self.get_encode_command(), writer, tmp, ogg, 
+                'oggenc')
+
+    def get_encode_command(self):
+        '''Implements IEncoder.get_encode_command.'''
+        # oggenc writes to stdout when reading from stdin
+        return ['oggenc', '--quiet', '-']
 
 class Mp3Encoder(IEncoder):
     '''
     Encodes audio as MP3 using LAME from the command line.
     '''
-    def __init__(self, path):
+    def __init__(self, path, profile=None):
         '''Implements IEncoder constructor.'''
         self._path = path
 
     def encode_wav(self, hashFn):
         '''Implements IEncoder.encode_wav.'''
-        wav = os.path.join(self._path, hashFn+'.wav')
-        mp3 = os.path.join(self._path, hashFn+'.mp3')
+        wav = cache.get_path(self._path, hashFn+'.wav')
+        mp3 = cache.make_path(self._path, hashFn+'.mp3')
         if not os.path.isfile(mp3):
-            c = iterpipes.cmd('lame --quiet {}  {}', wav, mp3)
+            tmp = cache.get_temp_path(mp3)
+            c = iterpipes.cmd('lame --quiet {}  {}', wav, tmp)
             ret = iterpipes.call(c)
+            _move_into_place(ret, tmp, mp3, 'lame')
+
+    def encode_stream(self, hashFn, writer):
+        '''Implements IEncoder.encode_stream.'''
+        mp3 = cache.make_path(self._path, hashFn+'.mp3')
+        if not os.path.isfile(mp3):
+            tmp = cache.get_temp_path(mp3)
+            _pipe_into_place(self.get_encode_command(), writer, tmp, mp3, 
+                'lame')
+
+    def get_encode_command(self):
+        '''Implements IEncoder.get_encode_command.'''
+        return ['lame', '--quiet', '-', '-']
+
+class OpusEncoder(IEncoder):
+    '''
+    Encodes speech as Ogg Opus using opusenc from the command line. Opus
+    needs far fewer bits than Vorbis or MP3 for speech of the same quality.
+    
+    :cvar DEFAULT_PROFILE: Profile used when none is requested
+    :cvar EXTENSION: Extension of the encoded files with the prefix `.`
+    :cvar COMMAND: Name of the encoder command for error reporting
+    '''
+    # profiles paired with bitrates in kbps
+    PROFILES = {'low' : 12, 'medium' : 20, 'high' : 32}
+    # most players stop at the end of the first stream of chained Ogg Opus
+    # and Matroska files cannot be concatenated at all
+    JOINABLE = False
+    DEFAULT_PROFILE = 'medium'
+    EXTENSION = '.opus'
+    COMMAND = 'opusenc'
+
+    def __init__(self, path, profile=None):
+        '''Implements IEncoder constructor.'''
+        self._path = path
+        self._profile = profile
+        try:
+            self._bitrate = self.PROFILES[profile or self.DEFAULT_PROFILE]
+        except KeyError:
+            raise EncoderError('unknown encoder profile')
+
+    def encode_wav(self, hashFn):
+        '''Implements IEncoder.encode_wav.'''
+        wav = cache.get_path(self._path, hashFn+'.wav')
+        def writer(out):
+            fh = open(wav, 'rb')
+            try:
+                shutil.copyfileobj(fh, out)
+            finally:
+                fh.close()
+        try:
+            self.encode_stream(hashFn, writer)
+        except IOError, e:
+            raise EncoderError(str(e))
+
+    def encode_stream(self, hashFn, writer):
+        '''Implements IEncoder.encode_stream.'''
+        ext = self.EXTENSION
+        if self._profile is not None:
+            ext = '.' + self._profile + ext
+        fn = cache.make_path(self._path, hashFn+ext)
+        if not os.path.isfile(fn):
+            tmp = cache.get_temp_path(fn)
+            _pipe_into_place(self.get_encode_command(), writer, tmp, fn, 
+                self.COMMAND)
+
+    def get_encode_command(self):
+        '''Implements IEncoder.get_encode_command.'''
+        return ['opusenc', '--quiet', '--bitrate', str(self._bitrate), '-', 
+            '-']
+
+class WebmEncoder(OpusEncoder):
+    '''
+    Encodes speech as Opus in a WebM container using ffmpeg from the command
+    line for browsers that play WebM but not Ogg.
+    '''
+    EXTENSION = '.webm'
+    COMMAND = 'ffmpeg'
+
+    def get_encode_command(self):
+        '''Implements IEncoder.get_encode_command.'''
+        return ['ffmpeg', '-loglevel', 'error', '-f', 'wav', '-i', '-',
+            '-c:a', 'libopus', '-b:a', '%dk' % self._bitrate, 
+            '-application', 'voip', '-f', 'webm', '-']
+
+def split_name(name):
+    '''
+    Splits the name of an encoded file into its parts.
+    
+    :param name: Filename relative to the cache folder
+    :type name: str
+    :return: Tuple of (root name, profile name or None, extension with the
+        prefix `.`)
+    :rtype: tuple
+    '''
+    parts = name.split('.')
+    if len(parts) > 2:
+        return parts[0], parts[1], '.' + '.'.join(parts[2:])
+    return parts[0], None, '.' + '.'.join(parts[1:])
+
+# libsndfile constants
+SFM_WRITE = 0x20
+SF_FORMAT_OGG = 0x200000
+SF_FORMAT_VORBIS = 0x0060
+SF_FORMAT_MPEG = 0x230000
+SF_FORMAT_MPEG_LAYER_III = 0x0082
+
+class SF_INFO(ctypes.Structure):
+    _fields_ = [
+        ('frames', ctypes.c_int64),
+        ('samplerate', ctypes.c_int),
+        ('channels', ctypes.c_int),
+        ('format', ctypes.c_int),
+        ('sections', ctypes.c_int),
+        ('seekable', ctypes.c_int)
+    ]
+
+class LibSndfile(object):
+    '''
+    Wraps libsndfile for writing encoded audio files from 16-bit PCM. The 
+    library and its function prototypes are set up once per process and 
+    shared by all encoders, obtained with get_instance.
+    
+    :ivar _lib: ctypes handle to libsndfile
+    :cvar INSTANCE: Singleton instance for this process
+    '''
+    INSTANCE = None
+
+    def __init__(self, lib):
+        '''
+        Constructor.
+        
+        :param lib: ctypes handle to libsndfile
+        :type lib: ctypes.CDLL
+        '''
+        self._lib = lib
+        lib.sf_open.restype = ctypes.c_void_p
+        lib.sf_open.argtypes = [ctypes.c_char_p, ctypes.c_int, 
+            ctypes.POINTER(SF_INFO)]
+        lib.sf_writef_short.restype = ctypes.c_int64
+        lib.sf_writef_short.argtypes = [ctypes.c_void_p, ctypes.c_char_p, 
+            ctypes.c_int64]
+        lib.sf_close.argtypes = [ctypes.c_void_p]
+        lib.sf_strerror.restype = ctypes.c_char_p
+        lib.sf_strerror.argtypes = [ctypes.c_void_p]
+        lib.sf_format_check.argtypes = [ctypes.POINTER(SF_INFO)]
+
+    @classmethod
+    def get_instance(cls):
+        '''
+        Gets the library wrapper for this process, creating it on first use.
+        
+        :return: Library wrapper
+        :rtype: LibSndfile
+        '''
+        if cls.INSTANCE is None:
+            cls.INSTANCE = cls(LIBSNDFILE)
+        return cls.INSTANCE
+
+    def check_format(self, format):
+        '''
+        :param format: libsndfile major and minor format
+        :type format: int
+        :return: True if the library can write speech in the format
+        :rtype: bool
+        '''
+        info = SF_INFO(0, 22050, 1, format, 0, 0)
+        return bool(self._lib.sf_format_check(ctypes.byref(info)))
+
+    def write(self, fn, pcm, sampleRate, channels, format):
+        '''
+        Encodes PCM to a file.
+        
+        :param fn: Path of the file to write
+        :type fn: str
+        :param pcm: 16-bit little endian PCM
+        :type pcm: str
+        :param sampleRate: Sample rate of the PCM in Hz
+        :type sampleRate: int
+        :param channels: Number of interleaved channels in the PCM
+        :type channels: int
+        :param format: libsndfile major and minor format
+        :type format: int
+        :raises: EncoderError
+        '''
+        info = SF_INFO(0, sampleRate, channels, format, 0, 0)
+        handle = self._lib.sf_open(fn, SFM_WRITE, ctypes.byref(info))
+        if not handle:
+            raise EncoderError('libsndfile failed: %s' % 
+                self._lib.sf_strerror(None))
+        try:
+            frames = len(pcm) // (2 * channels)
+            if self._lib.sf_writef_short(handle, pcm, frames) != frames:
+                raise EncoderError('libsndfile failed: %s' % 
+                    self._lib.sf_strerror(handle))
+        finally:
+            self._lib.sf_close(handle)
+
+def _read_all(fh, chunks):
+    # collect everything written to the other end of a pipe
+    while True:
+        chunk = fh.read(64 * 1024)
+        if not chunk:
+            break
+        chunks.append(chunk)
+    fh.close()
+
+class SndfileEncoder(object):
+    '''
+    Mixin implementing IEncoder by encoding in-process with libsndfile 
+    instead of starting an encoder command for every utterance. Produces the
+    same container format under the same cache filenames as the command line
+    encoder it is mixed into.
+    
+    :cvar SF_FORMAT: libsndfile major and minor format to write
+    :cvar EXTENSION: Extension of the encoded files with the prefix `.`
+    '''
+    SF_FORMAT = None
+    EXTENSION = None
+
+    def encode_wav(self, hashFn):
+        '''Implements IEncoder.encode_wav.'''
+        fn = cache.make_path(self._path, hashFn+self.EXTENSION)
+        if not os.path.isfile(fn):
+            wav = cache.get_path(self._path, hashFn+'.wav')
+            try:
+                fh = open(wav, 'rb')
+            except IOError, e:
+                raise EncoderError(str(e))
+            try:
+                data = fh.read()
+            finally:
+                fh.close()
+            self._encode(data, fn)
+
+    def encode_stream(self, hashFn, writer):
+        '''Implements IEncoder.encode_stream.'''
+        fn = cache.make_path(self._path, hashFn+self.EXTENSION)
+        if not os.path.isfile(fn):
+            # give the writer a real pipe since engines may hand it to a 
+            # child process
+            r, w = os.pipe()
+            chunks = []
+            reader = threading.Thread(target=_read_all, 
+                args=(os.fdopen(r, 'rb'), chunks))
+            reader.start()
+            out = os.fdopen(w, 'wb')
+            try:
+                writer(out)
+            finally:
+                out.close()
+                reader.join()
+            self._encode(''.join(chunks), fn)
 
-# global list of available synth implementations
-# @todo: add these dynamically if the synths actually work on the platform
-ENCODERS = {'.ogg' : OggEncoder, '.mp3' : Mp3Encoder}
+    def _encode(self, data, fn):
+        '''
+        Encodes WAV data to a file, writing it under a temporary name first.
+        
+        :param data: Bytes of a WAV file with 16-bit samples
+        :type data: str
+        :param fn: Final path of the encoded file
+        :type fn: str
+        :raises: EncoderError
+        '''
+        try:
+            wav = wave.open(StringIO.StringIO(data), 'rb')
+            if wav.getsampwidth() != 2:
+                raise EncoderError('unsupported WAV sample width')
+            # streamed WAV headers may overstate the length, read to the end
+            pcm = wav.readframes(len(data))
+        except (wave.Error, EOFError), e:
+            raise EncoderError('invalid WAV data: %s' % e)
+        tmp = cache.get_temp_path(fn)
+        try:
+            LibSndfile.get_instance().write(tmp, pcm, wav.getframerate(), 
+                wav.getnchannels(), self.SF_FORMAT)
+        except:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            raise
+        os.rename(tmp, fn)
+
+class SndfileOggEncoder(SndfileEncoder, OggEncoder):
+    '''
+    Encodes audio using Ogg Vorbis in-process with libsndfile.
+    '''
+    SF_FORMAT = SF_FORMAT_OGG | SF_FORMAT_VORBIS
+    EXTENSION = '.ogg'
+
+class SndfileMp3Encoder(SndfileEncoder, Mp3Encoder):
+    '''
+    Encodes audio as MP3 in-process with libsndfile built with LAME.
+    '''
+    SF_FORMAT = SF_FORMAT_MPEG | SF_FORMAT_MPEG_LAYER_III
+    EXTENSION = '.mp3'
+
+# global list of available encoder implementations, preferring in-process
+# encoding when libsndfile can write the format
+ENCODERS = {'.ogg' : OggEncoder, '.mp3' : Mp3Encoder, 
+    '.opus' : OpusEncoder, '.webm' : WebmEncoder}
+LIBSNDFILE = None
+try:
+    LIBSNDFILE = ctypes.CDLL(ctypes.util.find_library('sndfile') or 
+        'libsndfile.so.1')
+except OSError:
+    pass
+else:
+    for cls in (SndfileOggEncoder, SndfileMp3Encoder):
+        if LibSndfile.get_instance().check_format(cls.SF_FORMAT):
+            ENCODERS[cls.EXTENSION] = cls
 
 def get_class(format):
     '''
@@ -2,20 +2,29 @@
 Speech server implementation for JSonic using Tornado web server and Mongo 
 database.
 
-:requires: Python 2.6, Tornado 1.0
+:requires: Python 2.6, Tornado 1.1
 :copyright: Peter Parente 2010
 :license: BSD
 '''
 import synthesizer
 import encoder
+import cache
+import catalog
+import pack
+import pipeline
+import scheduler
+import segment
+import startup
+import workers
 import tornado.httpserver
 import tornado.ioloop
 import tornado.web
-from tornado.escape import json_encode, json_decode
+from tornado.escape import json_decode
 import multiprocessing
 import email.utils
 import mimetypes
 import datetime
+import calendar
 import time
 import os
 import sys
@@ -23,6 +32,10 @@ import stat
 import optparse
 import logging
 import functools
+import itertools
+import uuid
+import cStringIO
+import multiprocessing.pool
 
 # current server api version
 VERSION = '0.4'
@@ -32,15 +45,112 @@ try:
     os.mkdir(CACHE_PATH)
 except OSError:
     pass
+# mimetypes does not know the newer speech formats
+mimetypes.add_type('audio/ogg', '.opus')
+mimetypes.add_type('audio/webm', '.webm')
+# keep synthesized WAV files in the cache folder after encoding them? set by
+# run before forking the worker pool
+KEEP_WAV = False
+# most engine and encoder instances reused across jobs in each process
+MAX_INSTANCES = 64
+# keys of reused instances paired with lists of [last use, instance]
+INSTANCES = {}
+INSTANCE_USES = itertools.count()
 
-def synthesize(engineCls, encoderCls, utterances, properties):
+def get_instance(key, factory):
+    '''
+    Gets an engine or encoder instance from the cache of this process,
+    constructing it on the first request for the same key and dropping the
+    least recently used instance once there are more than MAX_INSTANCES.
+    Instances are reused across jobs because they hold no state beyond what
+    they derive from their constructor arguments.
+
+    :param key: Hashable identity of the instance
+    :param factory: Invoked with no arguments to construct the instance
+    :type factory: callable
+    :return: Instance
+    '''
+    entry = INSTANCES.get(key)
+    if entry is None:
+        entry = INSTANCES[key] = [None, factory()]
+    entry[0] = INSTANCE_USES.next()
+    if len(INSTANCES) > MAX_INSTANCES:
+        oldest = min(INSTANCES, key=lambda k: INSTANCES[k][0])
+        del INSTANCES[oldest]
+    return entry[1]
+
+def get_engine(cls, properties):
+    '''
+    Gets an engine instance for speech properties. Properties that validate
+    to the same engine options share an instance.
+
+    :param cls: ISynthesizer implementation
+    :type cls: class
+    :param properties: Speech properties
+    :type properties: dict
+    :return: Instance of cls
+    :raises: SynthesizerError if the properties are invalid
+    '''
+    return get_instance((cls, cls.get_options(properties)), 
+        functools.partial(cls, CACHE_PATH, properties))
+
+def get_encoder(cls, profile=None):
+    '''
+    Gets an encoder instance for a quality profile.
+
+    :param cls: IEncoder implementation
+    :type cls: class
+    :param profile: Name of the encoder quality profile or None
+    :type profile: str
+    :return: Instance of cls
+    :raises: EncoderError if the profile is invalid
+    '''
+    return get_instance((cls, profile and str(profile)), 
+        functools.partial(cls, CACHE_PATH, profile))
+
+def get_engine_class(name):
+    '''
+    Gets a synthesizer class in a worker process. Workers fork before the
+    server discovers the engines, so each discovers them on its first job,
+    reusing the engine info the server persisted in the catalog.
+
+    :param name: Name of the synthesizer
+    :type name: str
+    :return: ISynthesizer class or None if the name is unknown
+    :rtype: cls
+    :raises: SynthesizerError if a required engine is unavailable
+    '''
+    if not synthesizer.AVAILABLE_SYNTHS:
+        engines = catalog.EngineCatalog(CACHE_PATH)
+        synthesizer.init(engines.get_fingerprints())
+        engines.load(synthesizer.AVAILABLE_SYNTHS)
+    return synthesizer.get_class(name)
+
+def describe_error(e):
+    '''
+    Describes an unexpected exception raised in a worker process for the
+    response of the worker.
+
+    :param e: Exception raised
+    :type e: Exception
+    :return: Developer-readable explanation of the error
+    :rtype: str
+    '''
+    return '%s: %s' % (e.__class__.__name__, e)
+
+def synthesize(engineName, encoderCls, utterances, properties, profile=None):
     '''
     Executes speech synthesis and encoding in a separate process in the worker 
-    pool to avoid blocking the Tornado server.
+    pool to avoid blocking the Tornado server. The utterances may come from
+    many requests batched together, so one failing does not stop the rest.
+    Utterances left when the task is cancelled fail without being 
+    synthesized.
     
-    :param engineCls: ISynthesizer implementation to use for synth
-    :type engineCls: class
-    :param encoderCls: IEncoder implementation to use for encoding
+    :param engineName: Name of the synthesizer to use for synth, classes of
+        engine modules cannot be sent to workers forked before they loaded
+    :type engineName: str
+    :param encoderCls: IEncoder implementation to use for encoding or None
+        to only write WAV files for encoding later
     :type encoderCls: class
     :param utterances: Dictionary of utterance IDs (keys) paired with unicode
         utterance strings to synthesize (values)
@@ -49,6 +159,8 @@ def synthesize(engineCls, encoderCls, utterances, properties):
         The properties supported are determined by the engineCls implementation
         of ISynthesizer.get_info.
     :type properties: dict
+    :param profile: Name of the encoder quality profile or None
+    :type profile: str
     :return: A dictionary describing the results of worker in the following
         format on success:
         
@@ -68,36 +180,114 @@ def synthesize(engineCls, encoderCls, utterances, properties):
         
         {
             'success' : False,
-            'description' : <str>
+            'description' : <str>,
+            'result' : {...},
+            'errors' : {
+                'id3' : <str>,
+                ...
+            }
         }
         
         where the description is a developer-readable explanation of why
-        synthesis failed.
+        synthesis failed, the result holds the utterances that succeeded if
+        any, and the errors explain why each of the others failed if the 
+        engine and encoder could be set up at all.
+
+        Either format has a 'wav' field set to true if WAV files were kept
+        in the cache folder next to the encodings.
     :rtype: dict
     '''
     response = {'success' : False}
     try:
-        engine = engineCls(CACHE_PATH, properties)
-    except synthesizer.SynthesizerError, e:
+        engineCls = get_engine_class(engineName)
+        if engineCls is None:
+            response['description'] = 'unknown speech engine'
+            return response
+        engine = get_engine(engineCls, properties)
+        enc = encoderCls and get_encoder(encoderCls, profile)
+    except (synthesizer.SynthesizerError, encoder.EncoderError), e:
         response['description'] = str(e)
         return response
+    except Exception, e:
+        # the pool drops exceptions, always respond so waiters are released
+        response['description'] = describe_error(e)
+        return response
+    result = {}
+    errors = {}
+    response['wav'] = enc is not None and KEEP_WAV
+    for key, text in utterances.items():
+        if workers.is_cancelled():
+            errors[key] = scheduler.CANCELLED
+            continue
+        try:
+            if enc is None:
+                hashFn = engine.write_wav(text)
+            elif KEEP_WAV:
+                hashFn = engine.write_wav(text)
+                enc.encode_wav(hashFn)
+            else:
+                # pipe speech straight into the encoder
+                hashFn = engine.get_hash(text)
+                writer = functools.partial(engine.stream_wav, text)
+                enc.encode_stream(hashFn, writer)
+        except (synthesizer.SynthesizerError, encoder.EncoderError), e:
+            errors[key] = str(e)
+            continue
+        except Exception, e:
+            # broken pipes, full disks and the like
+            errors[key] = describe_error(e)
+            continue
+        result[key] = hashFn
+    response['result'] = result
+    if errors:
+        response['errors'] = errors
+        if workers.is_cancelled():
+            # commands killed by the cancellation fail with other errors
+            response['description'] = scheduler.CANCELLED
+        else:
+            response['description'] = errors.values()[0]
+        return response
+    response['success'] = True
+    return response
+
+def encode(encoderCls, hashFn, profile=None):
+    '''
+    Encodes a WAV file already in the cache folder in a separate process in
+    the worker pool to avoid blocking the Tornado server.
+    
+    :param encoderCls: IEncoder implementation to use for encoding
+    :type encoderCls: class
+    :param hashFn: Root name of the WAV file on disk, sans extension
+    :type hashFn: str
+    :param profile: Name of the encoder quality profile or None
+    :type profile: str
+    :return: A dictionary describing the results of the worker in the format
+        returned by synthesize, without a result on success
+    :rtype: dict
+    '''
+    response = {'success' : False}
+    if workers.is_cancelled():
+        response['description'] = scheduler.CANCELLED
+        return response
     try:
-        enc = encoderCls(CACHE_PATH)
+        get_encoder(encoderCls, profile).encode_wav(hashFn)
     except encoder.EncoderError, e:
         response['description'] = str(e)
         return response
+    except Exception, e:
+        response['description'] = describe_error(e)
+        return response
     response['success'] = True
-    response['result'] = {}
-    for key, text in utterances.items():
-        hashFn = engine.write_wav(text)
-        enc.encode_wav(hashFn)
-        response['result'][key] = hashFn
     return response
 
 class JSonicHandler(tornado.web.RequestHandler):
     '''
     Base class for all handlers.
+
+    :ivar starting: True while the request waits for the server to start
     '''
+    starting = False
+
     def send_json_error(self, response):
         '''
         Sends a HTTP 500 error with a JSON body containing more information
@@ -115,6 +305,42 @@ class JSonicHandler(tornado.web.RequestHandler):
         message = self.write(response)
         self.finish(message)
 
+    def send_json_busy(self):
+        '''
+        Sends a HTTP 503 error with a JSON body and a Retry-After header 
+        estimated from the synthesis queue when the server has no room for
+        more synthesis work. Finishes the HTTP response to prevent further 
+        output.
+        '''
+        sched = self.application.settings['scheduler']
+        self.clear()
+        self.set_status(503)
+        self.set_header('Retry-After', str(sched.get_retry_after()))
+        self.finish({'success' : False, 'description' : scheduler.BUSY})
+
+    def wait_for_startup(self, method, *args):
+        '''
+        Defers a request that needs the speech engines or the worker
+        processes until the server finishes starting them.
+
+        :param method: Handler method to invoke again once ready
+        :type method: callable
+        :return: True if the request was deferred
+        :rtype: bool
+        '''
+        boot = self.application.settings['startup']
+        if boot.ready:
+            return False
+        self.starting = True
+        boot.when_ready(self.async_callback(self._on_startup, method, 
+            args))
+        return True
+
+    def _on_startup(self, method, args):
+        self.starting = False
+        if not self.request.connection.stream.closed():
+            method(*args)
+
 class SynthHandler(JSonicHandler):
     '''
     Synthesizes speech to an encoded file for a later fetch from a static file 
@@ -128,6 +354,10 @@ class SynthHandler(JSonicHandler):
         
         {
             "format" : <unicode>,
+            "profile" : <unicode>,
+            "segment" : <unicode>,
+            "deadline" : <number>,
+            "priority" : <unicode>,
             "utterances" : {
                 "id1" : <unicode>,
                 "id2" : <unicode>,
@@ -141,9 +371,15 @@ class SynthHandler(JSonicHandler):
         }
         
         where the format dicates the encoding for the resulting speech files,
-        the utterance values are the text to synthesize as speech,
-        and the property names and values are those supported by the selected
-        engine (also one of the properties).
+        the optional profile names one of the quality profiles of the encoder,
+        the optional segment mode is "playlist" or "join" to split utterances
+        into sentences and clauses that are synthesized and cached separately,
+        the optional deadline is the number of seconds the client is willing
+        to wait for the response, the optional priority is "interactive" for
+        speech a user is waiting to hear, the default, or "prefetch" for
+        speech synthesized ahead of playback, the utterance values are the
+        text to synthesize as speech, and the property names and values are
+        those supported by the selected engine (also one of the properties).
         
         Responds with information about the synthesized utterances in the
         following JSON format on success:
@@ -159,45 +395,421 @@ class SynthHandler(JSonicHandler):
         
         where the utterance keys match those in the request and the values are 
         the filenames of the synthesized files accessible using the 
-        FilesHandler. 
+        FilesHandler. The values are lists of the filenames of the segments
+        in order in playlist segment mode and the filenames of files joining
+        the segments in join segment mode.
 
-        Responds with the following JSON error if synthesis fails:
+        Responds with the following JSON error if synthesis fails or the
+        deadline passes:
         
         {
             "success" : false,
             "description" : <unicode>
         }
+
+        Synthesis nobody else waits on is cancelled if the deadline passes or 
+        the client disconnects.
         '''
+        if self.wait_for_startup(self.post):
+            return
         if self.application.settings['debug']:
             self.start_time = time.time()
         args = json_decode(self.request.body)
-        pool = self.application.settings['pool']
         engine = synthesizer.get_class(args['properties'].get('engine', 'espeak'))
         if engine is None:
             self.send_json_error({'description' : 'unknown speech engine'})
             return
-        enc = encoder.get_class(args.get('format', '.ogg'))
+        self._format = args.get('format', '.ogg')
+        enc = encoder.get_class(self._format)
         if enc is None:
             self.send_json_error({'description' : 'unknown encoder format'})
             return
-        params = (engine, enc, args['utterances'], args['properties'])
-        pool.apply_async(synthesize, params, callback=self._on_synth_complete)
-        #self.on_synth_complete(synthesize(*params))
+        profile = args.get('profile')
+        # name encodings with a profile <root>.<profile><format>
+        self._suffix = ''
+        if profile is not None:
+            if profile not in enc.PROFILES:
+                self.send_json_error({'description' : 
+                    'unknown encoder profile'})
+                return
+            profile = str(profile)
+            self._suffix = '.' + profile
+            self._format = self._suffix + self._format
+        try:
+            # compute filenames here to answer cache hits without the pool
+            synth = get_engine(engine, args['properties'])
+        except synthesizer.SynthesizerError, e:
+            self.send_json_error({'description' : str(e)})
+            return
+        self._segment = args.get('segment')
+        if self._segment not in (None, 'playlist', 'join'):
+            self.send_json_error({'description' : 'unknown segment mode'})
+            return
+        if self._segment == 'join' and not enc.JOINABLE:
+            self.send_json_error({'description' : 
+                'encoder format cannot be joined'})
+            return
+        deadline = args.get('deadline')
+        # JSON true and false decode as bool, a subclass of int
+        if deadline is not None and (not isinstance(deadline, (int, float))
+        or isinstance(deadline, bool) or deadline <= 0):
+            self.send_json_error({'description' : 'invalid deadline'})
+            return
+        priority = args.get('priority', scheduler.INTERACTIVE)
+        if priority not in scheduler.PRIORITIES:
+            self.send_json_error({'description' : 'unknown priority'})
+            return
+        priority = str(priority)
+        index = self.application.settings['index']
+        # answer once the WAV exists and encode it when it is first fetched,
+        # joining needs the encodings right away
+        lazy = (self.application.settings['lazy_encode'] and
+            self._segment != 'join')
+        # format of the files the scheduler produces for this request
+        self._synthFormat = lazy and '.wav' or self._format
+        self._timeout = None
+        self._response = {'success' : True, 'result' : {}}
+        # root names of the segments of each utterance
+        self._segments = {}
+        # utterance keys paired with sets of segments not yet synthesized
+        self._missing = {}
+        # segments being synthesized paired with the set of keys waiting on
+        # them, an utterance may repeat a segment
+        self._keys = {}
+        # segment filenames pinned until they are joined
+        self._pinned = {}
+        texts = {}
+        for key, text in args['utterances'].items():
+            if self._segment is None:
+                parts = [text]
+            else:
+                parts = segment.split_utterance(text) or [text]
+            hashFns = [synth.get_hash(part) for part in parts]
+            self._segments[key] = hashFns
+            self._missing[key] = missing = set()
+            if self._segment == 'join' and len(hashFns) > 1:
+                # keep segments from being evicted before they are joined
+                self._pinned[key] = names = [hashFn + self._format 
+                    for hashFn in hashFns]
+                for name in names:
+                    index.pin(name)
+            for hashFn, part in zip(hashFns, parts):
+                if (hashFn + self._format in index or 
+                lazy and hashFn + '.wav' in index):
+                    index.touch(hashFn + self._format)
+                else:
+                    missing.add(hashFn)
+                    self._keys.setdefault(hashFn, set()).add(key)
+                    texts[hashFn] = part
+        if texts:
+            # let the scheduler fan out the missing utterances across the pool
+            sched = self.application.settings['scheduler']
+            if lazy:
+                queued = sched.synthesize(engine, None, self._synthFormat, 
+                    args['properties'], texts, self.on_synth_complete, 
+                    None, priority)
+            else:
+                queued = sched.synthesize(engine, enc, self._format, 
+                    args['properties'], texts, self.on_synth_complete, 
+                    profile, priority)
+            if not queued:
+                self._fail(scheduler.BUSY)
+                return
+        if not self._missing:
+            self._send_result()
+            return
+        for key, missing in self._missing.items():
+            if not missing and self._response is not None:
+                self._resolve(key)
+        if deadline is not None and self._response is not None:
+            self._timeout = tornado.ioloop.IOLoop.instance().add_timeout(
+                time.time() + deadline, self._on_deadline)
 
-    def _on_synth_complete(self, response):
-        # schedule callback on the main thread
-		loop = tornado.ioloop.IOLoop.instance()
-		loop.add_callback(functools.partial(self.on_synth_complete, response))
-    
-    def on_synth_complete(self, response):
+    def on_synth_complete(self, hashFn, description):
+        keys = self._keys.pop(hashFn, ())
+        if self._response is None:
+            # an earlier utterance failed and already finished the request
+            return
+        if description is not None:
+            self._fail(description)
+            return
+        for key in keys:
+            missing = self._missing[key]
+            missing.discard(hashFn)
+            if not missing:
+                self._resolve(key)
+
+    def _resolve(self, key):
+        # all segments of an utterance are in the cache
+        hashFns = self._segments[key]
+        if key in self._pinned:
+            joiner = self.application.settings['joiner']
+            joiner.join(hashFns, self._format, 
+                functools.partial(self._on_joined, key))
+            return
+        if self._segment == 'playlist':
+            self._response['result'][key] = [hashFn + self._suffix 
+                for hashFn in hashFns]
+        else:
+            self._response['result'][key] = hashFns[0] + self._suffix
+        self._on_resolved(key)
+
+    def _on_joined(self, key, hashFn, description):
+        index = self.application.settings['index']
+        for name in self._pinned.pop(key, []):
+            index.unpin(name)
+        if self._response is None:
+            return
+        if description is not None:
+            self._fail(description)
+            return
+        self._response['result'][key] = hashFn + self._suffix
+        self._on_resolved(key)
+
+    def _on_resolved(self, key):
+        del self._missing[key]
+        if not self._missing:
+            self._send_result()
+
+    def _on_deadline(self):
+        self._timeout = None
+        self._fail('deadline exceeded')
+
+    def _abandon(self):
+        self._response = None
+        if self._timeout is not None:
+            tornado.ioloop.IOLoop.instance().remove_timeout(self._timeout)
+            self._timeout = None
+        # stop waiting on synthesis so the scheduler can drop work nobody 
+        # else needs
+        sched = self.application.settings['scheduler']
+        for hashFn in self._keys.keys():
+            sched.cancel(hashFn + self._synthFormat, self.on_synth_complete)
+        self._keys = {}
+        # joins in progress unpin their own segments
+        index = self.application.settings['index']
+        for key, names in self._pinned.items():
+            if self._missing[key]:
+                for name in names:
+                    index.unpin(name)
+                del self._pinned[key]
+
+    def _fail(self, description):
+        self._abandon()
+        if description == scheduler.BUSY:
+            self.send_json_busy()
+        else:
+            self.send_json_error({'description' : description})
+
+    def _send_result(self):
+        response = self._response
+        if self._timeout is not None:
+            tornado.ioloop.IOLoop.instance().remove_timeout(self._timeout)
+            self._timeout = None
         if self.application.settings['debug']:
             response['time'] = time.time() - self.start_time
-        if response['success']:
-            #self.set_header('Content-Type', 'application/json')
-            self.write(response)
-            self.finish()
+        #self.set_header('Content-Type', 'application/json')
+        self.write(response)
+        self.finish()
+
+    def on_connection_close(self):
+        if not self._finished and not self.starting:
+            self._abandon()
+
+class ChunkedWriter(object):
+    '''
+    Writes the body of a response with the chunked transfer encoding as it
+    is produced. Tornado 1.1 sends the body as written, so the chunks are
+    framed here. Later versions frame them with the ChunkedTransferEncoding
+    transform of the application, so the chunks are written as they are.
+
+    :ivar _handler: tornado.web.RequestHandler responding
+    :ivar _framing: True if chunks are framed here
+    '''
+    def __init__(self, handler):
+        '''
+        Constructor. Sets the Transfer-Encoding header if chunks are framed
+        here.
+
+        :param handler: Handler of a HTTP/1.1 request
+        :type handler: tornado.web.RequestHandler
+        '''
+        self._handler = handler
+        transform = getattr(tornado.web, 'ChunkedTransferEncoding', None)
+        self._framing = (transform is None or 
+            transform not in handler.application.transforms)
+        if self._framing:
+            handler.set_header('Transfer-Encoding', 'chunked')
+
+    def write(self, data):
+        '''
+        Sends a chunk to the client right away.
+
+        :param data: Bytes of the body, not empty
+        :type data: str
+        '''
+        if self._framing:
+            data = '%x\r\n%s\r\n' % (len(data), data)
+        self._handler.write(data)
+        self._handler.flush()
+
+    def finish(self):
+        '''
+        Ends the body and finishes the response.
+        '''
+        if self._framing:
+            self._handler.write('0\r\n\r\n')
+        self._handler.finish()
+
+class StreamHandler(JSonicHandler):
+    '''
+    Synthesizes speech for a single utterance and streams the encoded audio 
+    to the client while it is being synthesized. The file is written into the
+    cache at the same time for later fetches using the FilesHandler.
+    '''
+    @tornado.web.asynchronous
+    def get(self):
+        '''
+        Performs speech synthesis of the utterance in the text query argument
+        with the encoding in the format query argument, defaulting to .ogg,
+        the optional encoder quality profile in the profile query argument,
+        and the JSON encoded engine properties in the properties query 
+        argument, defaulting to none. The properties are those supported by 
+        SynthHandler.post.
+        
+        Responds with the encoded audio using chunked transfer encoding as
+        soon as the encoder produces it. Redirects to the file URL served by
+        FilesHandler instead if the file is already cached, is already being
+        synthesized for another request, if the engine cannot stream, if the
+        client does not support HTTP/1.1, or if all pipelines are busy.
+
+        Responds with the following JSON error if synthesis fails before any
+        audio is sent:
+        
+        {
+            "success" : false,
+            "description" : <unicode>
+        }
+        
+        Closes the connection without ending the chunked response if 
+        synthesis fails after audio is sent.
+        '''
+        if self.wait_for_startup(self.get):
+            return
+        self._streaming = False
+        self._closed = False
+        self._waiting = None
+        text = self.get_argument('text')
+        fmt = self.get_argument('format', '.ogg')
+        try:
+            properties = json_decode(self.get_argument('properties', '{}'))
+        except ValueError:
+            self.send_json_error({'description' : 'invalid properties'})
+            return
+        engine = synthesizer.get_class(properties.get('engine', 'espeak'))
+        if engine is None:
+            self.send_json_error({'description' : 'unknown speech engine'})
+            return
+        enc = encoder.get_class(fmt)
+        if enc is None:
+            self.send_json_error({'description' : 'unknown encoder format'})
+            return
+        profile = self.get_argument('profile', None)
+        if profile is not None:
+            if profile not in enc.PROFILES:
+                self.send_json_error({'description' : 
+                    'unknown encoder profile'})
+                return
+            profile = str(profile)
+            fmt = '.' + profile + fmt
+        try:
+            synth = get_engine(engine, properties)
+        except synthesizer.SynthesizerError, e:
+            self.send_json_error({'description' : str(e)})
+            return
+        hashFn = synth.get_hash(text)
+        self._name = hashFn + fmt
+        index = self.application.settings['index']
+        if self._name in index or hashFn + '.wav' in index:
+            # the file handler encodes the WAV if needed
+            index.touch(self._name)
+            self._redirect()
+            return
+        sched = self.application.settings['scheduler']
+        limiter = self.application.settings['limiter']
+        engineArgs = synth.get_wav_command()
+        if sched.is_full():
+            self.send_json_busy()
+            return
+        if (engineArgs is None or not self.request.supports_http_1_1() or
+        limiter.is_full() or not sched.claim(self._name)):
+            # wait for the file in the queue and serve it from the cache
+            self._waiting = self.async_callback(self._on_synth_complete)
+            if not sched.synthesize(engine, enc, fmt, properties, 
+            {hashFn : text}, self._waiting, profile):
+                self._waiting = None
+                self.send_json_busy()
+            return
+        mime_type, encoding = mimetypes.guess_type(self._name)
+        self.set_header('Content-Type', 
+            mime_type or 'application/octet-stream')
+        self._writer = ChunkedWriter(self)
+        self._pipeline = pipeline.Pipeline([engineArgs, 
+            get_encoder(enc, profile).get_encode_command()], 
+            text.encode('utf-8'), cache.make_path(CACHE_PATH, self._name),
+            self.application.settings['io_pool'],
+            self.async_callback(self._on_chunk), 
+            functools.partial(self._on_stream_complete, hashFn))
+        limiter.acquire(self._pipeline.start)
+
+    def _on_synth_complete(self, hashFn, description):
+        self._waiting = None
+        if self._closed:
+            return
+        if description == scheduler.BUSY:
+            self.send_json_busy()
+        elif description is not None:
+            self.send_json_error({'description' : description})
         else:
-            self.send_json_error(response)
+            self._redirect()
+
+    def _redirect(self):
+        self.redirect('files/' + self._name)
+
+    def _on_chunk(self, data):
+        if self._closed:
+            # keep filling the cache for later requests
+            return
+        self._streaming = True
+        self._writer.write(data)
+
+    def _on_stream_complete(self, hashFn, description):
+        self.application.settings['limiter'].release()
+        # update the cache whether or not the client is still listening
+        self.application.settings['scheduler'].release(self._name, hashFn,
+            description)
+        if self._closed:
+            return
+        if description is not None and self._streaming:
+            # the client has a partial response, cut it off
+            self.request.connection.stream.close()
+        elif description is not None:
+            self.send_json_error({'description' : description})
+        elif self._streaming:
+            self._writer.finish()
+        else:
+            # nothing was encoded, let the file handler respond
+            self.clear()
+            self._redirect()
+
+    def on_connection_close(self):
+        if self.starting:
+            return
+        self._closed = True
+        if self._waiting is not None:
+            self.application.settings['scheduler'].cancel(self._name, 
+                self._waiting)
+            self._waiting = None
 
 class VersionHandler(tornado.web.RequestHandler):
     '''
@@ -216,8 +828,11 @@ class VersionHandler(tornado.web.RequestHandler):
 
 class EngineHandler(JSonicHandler):
     '''
-    Retrieves information about available speech synthesis engines.
+    Retrieves information about available speech synthesis engines from the
+    catalog computed at startup. Responses carry a strong ETag so that clients
+    can revalidate them without transferring the info again.
     '''
+    @tornado.web.asynchronous
     def get(self, name=None):
         '''
         Responds with a list of all engines if name is None in the following 
@@ -249,6 +864,9 @@ class EngineHandler(JSonicHandler):
             }
         }
         
+        Responds with a 304 and no body if the If-None-Match header of the
+        request lists the ETag of the current response.
+
         Responds with the following JSON error if information about the named
         engine is unavailable:
         
@@ -261,29 +879,250 @@ class EngineHandler(JSonicHandler):
             a list of all supported engines. Defaults to None.
         :param name: str
         '''
-        if name is None:
-            names = synthesizer.AVAILABLE_SYNTHS.keys()
-            ret = {'success' : True, 'result' : names}
-            self.write(json_encode(ret))
-        else:
-            cls = synthesizer.get_class(name)
-            if cls is None:
+        if self.wait_for_startup(self.get, name):
+            return
+        engines = self.application.settings['catalog']
+        response = engines.get_response(name)
+        if response is None:
+            if synthesizer.get_class(name) is None:
                 self.send_json_error({'description' : 'invalid engine'})
             else:
-                info = cls.get_info()
-                ret = {'success' : True, 'result' : info}
-                self.write(ret)
+                self.send_json_error({'description' : 
+                    'engine information unavailable'})
+            return
+        body, etag = response
+        self.set_header('Etag', etag)
+        inm_value = self.request.headers.get('If-None-Match')
+        if inm_value is not None and (etag in 
+        [tag.strip() for tag in inm_value.split(',')] or inm_value == '*'):
+            self.set_status(304)
+            self.finish()
+            return
+        self.set_header('Content-Type', 'text/javascript; charset=UTF-8')
+        self.finish(body)
+
+class StatsHandler(JSonicHandler):
+    '''
+    Retrieves counters describing the caches and synthesis work of the server
+    for monitoring and capacity planning.
+    '''
+    def get(self):
+        '''
+        Responds with server statistics in the following JSON format:
+        
+        {
+            "success" : true,
+            "result" : {
+                "files" : {
+                    "files" : <number>,
+                    "bytes" : <number>,
+                    "evicted" : <number>,
+                    "max_bytes" : <number>,
+                    "max_files" : <number>
+                },
+                "in_flight" : <number>,
+                "memory_cache" : {
+                    "hits" : <number>,
+                    "misses" : <number>,
+                    "entries" : <number>,
+                    "bytes" : <number>,
+                    "max_bytes" : <number>
+                },
+                "pack" : {
+                    "files" : <number>,
+                    "segments" : <number>,
+                    "bytes" : <number>,
+                    "live_bytes" : <number>
+                },
+                "subprocesses" : {
+                    "running" : <number>,
+                    "waiting" : <number>,
+                    "limit" : <number>
+                },
+                "queue" : {
+                    "depth" : <number>,
+                    "interactive" : <number>,
+                    "prefetch" : <number>,
+                    "max_depth" : <number>,
+                    "running" : <number>,
+                    "slots" : <number>,
+                    "rejected" : <number>,
+                    "cancelled" : <number>,
+                    "service_time" : <number>,
+                    "wait_estimate" : <number>,
+                    "interactive_wait_estimate" : <number>
+                },
+                "startup" : {
+                    "ready" : <bool>,
+                    "indexed" : <bool>,
+                    "phases" : [
+                        {
+                            "name" : <unicode>,
+                            "seconds" : <number>
+                        },
+                        ...
+                    ],
+                    "seconds" : <number>
+                },
+                "workers" : [
+                    {
+                        "running" : <number>,
+                        "tasks" : <number>,
+                        "hits" : <number>,
+                        "steals" : <number>,
+                        "warm" : [<unicode>, <unicode>, ...]
+                    },
+                    ...
+                ]
+            }
+        }
+        
+        where files describes the cache folder and its budget, in_flight is
+        the number of files being synthesized, queue describes synthesis jobs
+        waiting for a slot by priority with the estimated seconds a new
+        prefetch or interactive job waits, startup reports whether the
+        engines are up, whether the cache folder is indexed, and how long
+        each phase of starting the server took, workers lists the engine and
+        property hashes each worker process has run lately as its warm set,
+        pack is present only if the pack store is enabled, and subprocesses
+        describes the engine and encoder pipelines run by the server process
+        for streams and, if enabled, for all synthesis.
+        '''
+        settings = self.application.settings
+        result = {
+            'files' : settings['cache_manager'].get_stats(),
+            'in_flight' : settings['scheduler'].get_in_flight(),
+            'memory_cache' : settings['memory_cache'].get_stats(),
+            'queue' : settings['scheduler'].get_queue_stats(),
+            'startup' : settings['startup'].get_stats(),
+            'workers' : settings['pool'].get_stats()
+        }
+        if settings['pack_store'] is not None:
+            result['pack'] = settings['pack_store'].get_stats()
+        result['subprocesses'] = settings['limiter'].get_stats()
+        self.write({'success' : True, 'result' : result})
+
+def parse_range(header, size):
+    '''
+    Parses the value of a HTTP Range header according to RFC 7233.
+    
+    :param header: Value of the Range header
+    :type header: str
+    :param size: Size of the requested file in bytes
+    :type size: int
+    :return: None if the header is malformed or not in bytes and must be
+        ignored, an empty list if no range is satisfiable, or a list of
+        (first, last) inclusive byte positions otherwise
+    :rtype: list
+    '''
+    try:
+        unit, specs = header.split('=', 1)
+    except ValueError:
+        return None
+    if unit.strip().lower() != 'bytes':
+        return None
+    ranges = []
+    for spec in specs.split(','):
+        spec = spec.strip()
+        if not spec:
+            continue
+        try:
+            first, last = spec.split('-', 1)
+            if not first:
+                # suffix range for the last N bytes
+                suffix = int(last)
+                if suffix < 0:
+                    return None
+                if suffix > 0 and size > 0:
+                    ranges.append((max(size - suffix, 0), size - 1))
+                continue
+            first = int(first)
+            if last:
+                last = int(last)
+            else:
+                last = None
+        except ValueError:
+            return None
+        if first < 0 or (last is not None and last < first):
+            return None
+        if first < size:
+            if last is None or last >= size:
+                last = size - 1
+            ranges.append((first, last))
+    return ranges
+
+def open_file(root, name):
+    '''
+    Finds, stats and opens a file in the cache folder for reading. Meant to 
+    run in the I/O thread pool so that slow disks do not stall the IOLoop.
+    
+    :param root: Path to where synthesized files are stored
+    :type root: str
+    :param name: Filename relative to the cache folder
+    :type name: str
+    :return: Tuple of (HTTP status code, open file or None, os.stat result
+        or None)
+    :rtype: tuple
+    '''
+    abspath = cache.find_path(root, name)
+    if abspath is None:
+        return (404, None, None)
+    try:
+        stat_result = os.stat(abspath)
+        if not stat.S_ISREG(stat_result[stat.ST_MODE]):
+            return (403, None, None)
+        return (200, open(abspath, 'rb'), stat_result)
+    except (OSError, IOError):
+        return (404, None, None)
+
+def read_file(fh, start=0, size=-1):
+    '''
+    Reads bytes from an open file. Meant to run in the I/O thread pool so
+    that slow disks do not stall the IOLoop.
+
+    :param fh: Open file
+    :type fh: file
+    :param start: Offset of the first byte to read
+    :type start: int
+    :param size: Most bytes to read or -1 to read to the end of the file
+    :type size: int
+    :return: Bytes read or None if reading failed
+    :rtype: str
+    '''
+    try:
+        fh.seek(start)
+        return fh.read(size)
+    except (IOError, ValueError):
+        return None
 
 class FilesHandler(tornado.web.StaticFileHandler):
     '''
     Retrieves cached speech files. Overrides the base class implementation to
-    support partial content requests. 
+    support partial content requests and to stream files in bounded chunks 
+    without blocking the IOLoop on disk access. Files are opened and read in
+    the I/O thread pool.
     
     This handler should not be used if your deployment places the Tornado
     web server behind a proxy such as nginx which is much better at serving
     up static files. It is provided to make JSonic an all-in-one package if
     so desired.
+    
+    Speech filenames are hashes of their content so responses carry a strong
+    ETag derived from the filename and may be cached by clients and proxies
+    forever without revalidation.
+    
+    :cvar CHUNK_SIZE: Maximum number of bytes read and queued for the client
+        at once
+    :cvar MAX_AGE: Lifetime of cached responses in seconds
+    :cvar MAX_MEMORY_FILE_SIZE: Largest file kept in the in-memory cache
+    :cvar MAX_PACKED_FILE_SIZE: Largest file moved into the pack store
     '''
+    CHUNK_SIZE = 64 * 1024
+    MAX_AGE = 86400 * 365
+    MAX_MEMORY_FILE_SIZE = 64 * 1024
+    MAX_PACKED_FILE_SIZE = 64 * 1024
+
+    @tornado.web.asynchronous
     def get(self, path, include_body=True):
         '''
         Gets bytes from a synthesized, encoded speech file.
@@ -293,68 +1132,321 @@ class FilesHandler(tornado.web.StaticFileHandler):
         :param include_body: Include the body of the file if modified?
         :type include_body: bool
         '''
-        abspath = os.path.abspath(os.path.join(self.root, path))
-        if not abspath.startswith(self.root):
+        if os.path.basename(path) != path or path.startswith('.'):
             raise tornado.web.HTTPError(403, "%s is not in root static directory", path)
-        if not os.path.exists(abspath):
-            raise tornado.web.HTTPError(404)
-        if not os.path.isfile(abspath):
-            raise tornado.web.HTTPError(403, "%s is not a file", path)
+        self._fh = None
+        self._reading = False
+        self._pinned = False
+        self._waiting = None
+        self._name = path
+        self._include_body = include_body
+        index = self.application.settings['index']
+        index.touch(self._name)
+        entry = self.application.settings['memory_cache'].get(self._name)
+        if entry is not None:
+            # serve small, hot files straight from memory
+            self._serve(cStringIO.StringIO(entry[0]), *entry[1:])
+            return
+        # keep the file from being evicted while it is served
+        index.pin(self._name)
+        self._pinned = True
+        if self._name not in index and self._encode():
+            return
+        self._open()
 
-        stat_result = os.stat(abspath)
-        modified = datetime.datetime.fromtimestamp(stat_result[stat.ST_MTIME])
- 
-        self.set_header("Last-Modified", modified)
-        if "v" in self.request.arguments:
-            self.set_header("Expires", datetime.datetime.utcnow() + \
-                                       datetime.timedelta(days=365*10))
-            self.set_header("Cache-Control", "max-age=" + str(86400*365*10))
-        else:
-            self.set_header("Cache-Control", "public")
-        mime_type, encoding = mimetypes.guess_type(abspath)
-        if mime_type:
-            self.set_header("Content-Type", mime_type)
- 
-        # Check the If-Modified-Since, and don't send the result if the
-        # content has not been modified
-        ims_value = self.request.headers.get("If-Modified-Since")
-        if ims_value is not None:
-            date_tuple = email.utils.parsedate(ims_value)
-            if_since = datetime.datetime.fromtimestamp(time.mktime(date_tuple))
-            if if_since >= modified:
-                self.set_status(304)
+    def head(self, path):
+        '''
+        Gets the headers for a synthesized, encoded speech file.
+        
+        :param path: Path to the file
+        :type path: str
+        '''
+        self.get(path, include_body=False)
+
+    def _open(self):
+        if self._open_packed():
+            return
+        # stat and open in the thread pool
+        io = self.application.settings['io_pool']
+        io.apply_async(open_file, (self.root, self._name), 
+            callback=self._on_open_thread)
+
+    def _encode(self):
+        '''
+        Encodes the requested file from the WAV file sharing its root name if
+        the WAV is in the cache. Concurrent requests for the same file wait on
+        a single encoding.
+        
+        :return: True if the file is being encoded
+        :rtype: bool
+        '''
+        root, profile, ext = encoder.split_name(self._name)
+        enc = encoder.get_class(ext)
+        index = self.application.settings['index']
+        if (enc is None or profile is not None and profile not in enc.PROFILES
+        or root + '.wav' not in index):
+            return False
+        sched = self.application.settings['scheduler']
+        self._waiting = self.async_callback(self._on_encoded)
+        if not sched.encode(enc, self._name[len(root):], root, self._waiting,
+        profile):
+            self._waiting = None
+            self._close_file()
+            self._send_busy(sched)
+        return True
+
+    def _send_busy(self, sched):
+        self.set_status(503)
+        self.set_header('Retry-After', str(sched.get_retry_after()))
+        self.finish()
+
+    def _on_encoded(self, hashFn, description):
+        self._waiting = None
+        if self.request.connection.stream.closed():
+            return
+        if description is not None:
+            self._close_file()
+            raise tornado.web.HTTPError(500, '%s', description)
+        self._open()
+
+    def _on_open_thread(self, result):
+        # schedule callback on the main thread
+        loop = tornado.ioloop.IOLoop.instance()
+        loop.add_callback(self.async_callback(self._on_open, *result))
+
+    def _open_packed(self):
+        '''
+        Serves the requested file from the pack store if it is stored there.
+        
+        :return: True if the file is in the pack store
+        :rtype: bool
+        '''
+        store = self.application.settings['pack_store']
+        packed = store is not None and store.open(self._name)
+        if not packed:
+            return False
+        self._on_opened(*packed)
+        return True
+
+    def _on_open(self, status, fh, stat_result):
+        if status != 200:
+            # the loose file may have just moved into the pack store
+            if self._open_packed():
                 return
- 
-        if not include_body:
+            self._close_file()
+            raise tornado.web.HTTPError(status)
+        self._on_opened(fh, stat_result[stat.ST_SIZE], 
+            stat_result[stat.ST_MTIME])
+
+    def _on_opened(self, fh, size, mtime):
+        mime_type, encoding = mimetypes.guess_type(self._name)
+        if not mime_type:
+            mime_type = 'application/octet-stream'
+        modified = email.utils.formatdate(mtime, usegmt=True)
+        memcache = self.application.settings['memory_cache']
+        if size <= memcache.maxItemBytes:
+            # keep small files in memory along with their headers
+            self._in_pool(read_file, (fh,), functools.partial(
+                self._on_read_whole, fh, mtime, mime_type, modified))
+            return
+        self._serve(fh, size, mtime, mime_type, modified)
+
+    def _on_read_whole(self, fh, mtime, mime_type, modified, data):
+        fh.close()
+        if self.request.connection.stream.closed():
+            self._close_file()
             return
+        if data is None:
+            self._close_file()
+            raise tornado.web.HTTPError(500, 'could not read %s', self._name)
+        entry = (data, len(data), mtime, mime_type, modified)
+        self.application.settings['memory_cache'].put(self._name, entry, 
+            len(data))
+        self._serve(cStringIO.StringIO(data), len(data), mtime, mime_type, 
+            modified)
+
+    def _in_pool(self, func, args, callback):
+        # run in the thread pool, callback on the main thread
+        loop = tornado.ioloop.IOLoop.instance()
+        self.application.settings['io_pool'].apply_async(func, args, 
+            callback=lambda result: loop.add_callback(
+                self.async_callback(callback, result)))
+
+    def _serve(self, fh, size, mtime, mime_type, modified):
+        '''
+        Responds with the requested bytes of a file.
         
-        # check if there's a range request
+        :param fh: Open file or in-memory copy of the file
+        :type fh: file
+        :param size: Size of the file in bytes
+        :type size: int
+        :param mtime: Last modification time of the file in seconds since the
+            epoch
+        :type mtime: int
+        :param mime_type: Mimetype of the file
+        :type mime_type: str
+        :param modified: mtime formatted as a HTTP date
+        :type modified: str
+        '''
+        self._fh = fh
+        self.set_header("Last-Modified", modified)
+        # filenames are content hashes so the files never change, Tornado
+        # only leaves the header alone when spelled Etag
+        self.set_header("Etag", '"%s"' % self._name)
+        self.set_header("Expires", datetime.datetime.utcnow() + \
+                                   datetime.timedelta(seconds=self.MAX_AGE))
+        self.set_header("Cache-Control", 
+            "public, max-age=%d, immutable" % self.MAX_AGE)
+        self.set_header("Accept-Ranges", "bytes")
+        self.set_header("Content-Type", mime_type)
+ 
+        # don't send the result if the client already has the file
+        if self._not_modified(self._name, mtime):
+            self.set_status(304)
+            self._finish_file()
+            return
+
+        # build the list of body parts to send
         rng = self.request.headers.get('Range')
-        if rng is None:
+        ranges = None if rng is None else parse_range(rng, size)
+        if ranges is None:
             # send the whole file
-            start = 0
-            size = stat_result[stat.ST_SIZE]
-            self.set_header("Content-Length", str(size))
+            self._parts = size and [(0, size)] or []
+        elif not ranges:
+            self.set_status(416)
+            self.set_header("Content-Range", 'bytes */%d' % size)
+            self._finish_file()
+            return
+        elif len(ranges) == 1:
+            # send just the requested bytes
+            self.set_status(206)
+            start, end = ranges[0]
+            self.set_header("Content-Range", 'bytes %d-%d/%d' % 
+                (start, end, size))
+            self._parts = [(start, end - start + 1)]
         else:
+            # send a multipart/byteranges body
             self.set_status(206)
-            # send just the requested bytes
-            kind, rng = rng.split('=')
-            start, end = rng.split('-')
-            if not end: end = stat_result[stat.ST_SIZE]-1
-            start = int(start)
-            end = int(end)
-            size = end - start + 1
-            self.set_header("Content-Length", str(size))
-            self.set_header("Content-Range", 'bytes %d-%d/%d' %
-                (start, end, stat_result[stat.ST_SIZE]))
-        fh = open(abspath, "rb")
-        try:
-            fh.seek(start)
-            self.write(fh.read(size))
-        finally:
-            fh.close()
+            boundary = uuid.uuid4().hex
+            self.set_header("Content-Type", 
+                'multipart/byteranges; boundary=%s' % boundary)
+            self._parts = []
+            for start, end in ranges:
+                self._parts.append('\r\n--%s\r\nContent-Type: %s\r\n'
+                    'Content-Range: bytes %d-%d/%d\r\n\r\n' % 
+                    (boundary, mime_type, start, end, size))
+                self._parts.append((start, end - start + 1))
+            self._parts.append('\r\n--%s--\r\n' % boundary)
+        length = 0
+        for part in self._parts:
+            if isinstance(part, str):
+                length += len(part)
+            else:
+                length += part[1]
+        self.set_header("Content-Length", str(length))
+        if not self._include_body:
+            self._finish_file()
+            return
+        self.flush()
+        self._send_next()
+
+    def _not_modified(self, name, mtime):
+        '''
+        Checks the conditional request headers against the validators of a
+        file. If-None-Match takes precedence over If-Modified-Since.
+        
+        :param name: Filename used as the strong entity tag of the file
+        :type name: str
+        :param mtime: Last modification time of the file in seconds since the
+            epoch
+        :type mtime: int
+        :return: True if the client copy is current and a 304 should be sent
+        :rtype: bool
+        '''
+        inm_value = self.request.headers.get("If-None-Match")
+        if inm_value is not None:
+            for tag in inm_value.split(','):
+                tag = tag.strip()
+                if tag.startswith('W/'):
+                    tag = tag[2:]
+                if tag == '*' or tag.strip('"') == name:
+                    return True
+            return False
+        ims_value = self.request.headers.get("If-Modified-Since")
+        if ims_value is not None:
+            date_tuple = email.utils.parsedate(ims_value)
+            if date_tuple is not None:
+                # HTTP dates have whole seconds
+                return calendar.timegm(date_tuple) >= int(mtime)
+        return False
+
+    def _send_next(self):
+        # queue the next chunk once the previous one has been written to the
+        # socket so that at most CHUNK_SIZE bytes are held in memory
+        stream = self.request.connection.stream
+        if stream.closed():
+            self._close_file()
+            return
+        if not self._parts:
+            self._finish_file()
+            return
+        part = self._parts[0]
+        if isinstance(part, str):
+            self._parts.pop(0)
+            stream.write(part, self.async_callback(self._send_next))
+            return
+        start, remaining = part
+        args = (self._fh, start, min(remaining, self.CHUNK_SIZE))
+        if isinstance(self._fh, cStringIO.InputType):
+            # copies in memory are read right away
+            self._on_read(read_file(*args))
+        else:
+            self._reading = True
+            self._in_pool(read_file, args, self._on_read)
+
+    def _on_read(self, chunk):
+        self._reading = False
+        stream = self.request.connection.stream
+        if stream.closed():
+            self._close_file()
+            return
+        if not chunk:
+            # file shrank underneath us, give up on the connection
+            self._close_file()
+            stream.close()
+            return
+        start, remaining = self._parts[0]
+        if len(chunk) == remaining:
+            self._parts.pop(0)
+        else:
+            self._parts[0] = (start + len(chunk), remaining - len(chunk))
+        stream.write(chunk, self.async_callback(self._send_next))
+
+    def _finish_file(self):
+        self._close_file()
+        self.finish()
 
-def run(port=8888, processes=4, debug=False, static=False, pid=None):
+    def _close_file(self):
+        # a read in the thread pool closes the file once it ends
+        if self._fh is not None and not self._reading:
+            self._fh.close()
+            self._fh = None
+        if self._pinned:
+            self.application.settings['index'].unpin(self._name)
+            self._pinned = False
+
+    def on_connection_close(self):
+        if self._waiting is not None:
+            # let the scheduler drop the encoding if nobody else wants it
+            self.application.settings['scheduler'].cancel(self._name, 
+                self._waiting)
+            self._waiting = None
+        self._close_file()
+
+def run(port=8888, processes=4, debug=False, static=False, pid=None,
+keepWav=False, memoryCache=32, cacheSize=0, cacheFiles=0, packFiles=False,
+lazyEncode=False, subprocesses=0, queueDepth=1000, batchSize=8, 
+batchWindow=0):
     '''
     Runs an instance of the JSonic server.
     
@@ -374,7 +1466,48 @@ def run(port=8888, processes=4, debug=False, static=False, pid=None):
     :param pid: Name of a pid file to write if launching as a daemon or None
         to run in the foreground
     :type pid: string
+    :param keepWav: True to write synthesized speech to WAV files in the cache
+        before encoding and keep them. False to pipe speech straight into the
+        encoder and keep only the encoded files. Defaults to False.
+    :type keepWav: bool
+    :param memoryCache: Megabytes of memory to use for caching small speech 
+        files in FilesHandler or zero to disable. Defaults to 32.
+    :type memoryCache: int
+    :param cacheSize: Megabytes of disk to use for speech files before 
+        evicting the least recently used ones or zero for no limit. Defaults 
+        to 0.
+    :type cacheSize: int
+    :param cacheFiles: Number of speech files to keep on disk before 
+        evicting the least recently used ones or zero for no limit. Defaults
+        to 0.
+    :type cacheFiles: int
+    :param packFiles: True to move small speech files into append-only pack
+        files served from memory maps. False to keep every speech file in its
+        own file. Defaults to False.
+    :type packFiles: bool
+    :param lazyEncode: True to respond to synthesis requests once the WAV
+        file is written and encode it when it is first fetched. False to 
+        encode before responding. Defaults to False.
+    :type lazyEncode: bool
+    :param subprocesses: Maximum number of engine and encoder pipelines run
+        at once as children of the server process instead of in the worker
+        pool or zero to run all synthesis in the pool. Engines and encoders 
+        that cannot run as commands always run in the pool. Defaults to 0.
+    :type subprocesses: int
+    :param queueDepth: Most synthesis jobs allowed to wait for a worker or
+        pipeline before requests are refused with a 503 or zero for no limit.
+        Defaults to 1000.
+    :type queueDepth: int
+    :param batchSize: Most utterances from concurrent requests synthesized
+        together in one worker task, one to disable batching. Defaults to 8.
+    :type batchSize: int
+    :param batchWindow: Milliseconds new synthesis work waits for more work
+        to batch with it, zero to only batch work waiting for a free worker.
+        Defaults to 0.
+    :type batchWindow: int
     '''
+    global KEEP_WAV
+    KEEP_WAV = keepWav
     if pid is not None:
         # log to file
         logging.basicConfig(level=logging.INFO,
@@ -388,9 +1521,49 @@ def run(port=8888, processes=4, debug=False, static=False, pid=None):
         # log to console
         logging.basicConfig(level=logging.INFO,
                     format='%(asctime)s %(levelname)s %(message)s')
-    synthesizer.init()
     kwargs = {}
-    kwargs['pool'] = pool = multiprocessing.Pool(processes=processes)
+    # engines are probed after the socket listens
+    kwargs['catalog'] = engines = catalog.EngineCatalog(CACHE_PATH)
+    kwargs['startup'] = boot = startup.Startup(engines)
+    # fork before any thread starts or socket opens so that workers inherit
+    # neither, route jobs for the same voice to the same worker process
+    kwargs['pool'] = pool = workers.WorkerPool(processes)
+    boot.mark('workers')
+    # the folder is indexed after the socket listens
+    index = cache.CacheIndex(CACHE_PATH)
+    if subprocesses and keepWav:
+        logging.warning('--keep-wav runs all synthesis in the worker pool')
+        subprocesses = 0
+    kwargs['io_pool'] = multiprocessing.pool.ThreadPool(processes=processes)
+    # cap the engine and encoder commands run from the IOLoop, streams run
+    # them even if synthesis runs in the pool
+    kwargs['limiter'] = limiter = pipeline.ProcessLimiter(
+        subprocesses or processes)
+    if subprocesses:
+        executor = pipeline.PipelineExecutor(CACHE_PATH, limiter, 
+            kwargs['io_pool'])
+    else:
+        executor = None
+    kwargs['scheduler'] = scheduler.SynthScheduler(pool, synthesize, 
+        subprocesses or processes, index, encode, executor, queueDepth,
+        batchSize, batchWindow / 1000.0)
+    kwargs['lazy_encode'] = lazyEncode
+    kwargs['index'] = index
+    kwargs['memory_cache'] = cache.MemoryCache(memoryCache * 1024 * 1024,
+        FilesHandler.MAX_MEMORY_FILE_SIZE)
+    if packFiles:
+        kwargs['pack_store'] = store = pack.PackStore(
+            os.path.join(CACHE_PATH, 'packs'), CACHE_PATH, kwargs['io_pool'],
+            FilesHandler.MAX_PACKED_FILE_SIZE)
+        for name, size in store.iter_sizes():
+            index.add(name, size)
+    else:
+        kwargs['pack_store'] = None
+    kwargs['joiner'] = segment.SegmentJoiner(CACHE_PATH, index, 
+        kwargs['scheduler'], kwargs['io_pool'], kwargs['pack_store'])
+    kwargs['cache_manager'] = manager = cache.CacheManager(CACHE_PATH, index,
+        kwargs['io_pool'], kwargs['memory_cache'], cacheSize * 1024 * 1024, 
+        cacheFiles, kwargs['pack_store'])
     if static:
         # serve static files for debugging purposes
         kwargs['static_path'] = os.path.join(os.path.dirname(__file__), "../")
@@ -398,11 +1571,16 @@ def run(port=8888, processes=4, debug=False, static=False, pid=None):
         (r'/engine', EngineHandler),
         (r'/engine/([a-zA-Z0-9]+)', EngineHandler),
         (r'/synth', SynthHandler),
-        (r'/files/([a-f0-9]+-[a-f0-9]+\..*)', FilesHandler, {'path' : './files'}),
+        (r'/stream', StreamHandler),
+        (r'/files/([a-f0-9]+-[a-f0-9]+\..*)', FilesHandler, {'path' : CACHE_PATH}),
+        (r'/stats', StatsHandler),
         (r'/version', VersionHandler)
     ], debug=debug, **kwargs)
     http_server = tornado.httpserver.HTTPServer(application)
     http_server.listen(port)
+    boot.mark('listen')
+    boot.start(index, CACHE_PATH, [os.getpid()] + pool.get_pids())
+    manager.start()
     ioloop = tornado.ioloop.IOLoop.instance()
     ioloop.start()
 
@@ -420,11 +1598,35 @@ def run_from_args():
         default=False, help="enable Tornado debug mode w/ automatic loading (default=false)")
     parser.add_option("--static", dest="static", action="store_true", 
         default=False, help="enable Tornado sharing of the jsonic root folder (default=false)")
+    parser.add_option("--keep-wav", dest="keepWav", action="store_true", 
+        default=False, help="keep synthesized WAV files in the cache after encoding (default=false)")
+    parser.add_option("--memory-cache", dest="memoryCache", default=32,
+        help="megabytes of memory for caching small speech files (default=32)", type="int")
+    parser.add_option("--cache-size", dest="cacheSize", default=0,
+        help="megabytes of disk for speech files, 0 for no limit (default=0)", type="int")
+    parser.add_option("--cache-files", dest="cacheFiles", default=0,
+        help="number of speech files on disk, 0 for no limit (default=0)", type="int")
+    parser.add_option("--pack", dest="packFiles", action="store_true", 
+        default=False, help="store small speech files in pack files (default=false)")
+    parser.add_option("--lazy-encode", dest="lazyEncode", action="store_true", 
+        default=False, help="encode speech files when first fetched instead of when synthesized (default=false)")
+    parser.add_option("--subprocesses", dest="subprocesses", default=0,
+        help="run up to this many engine and encoder pipelines from the server process instead of the worker pool, e.g. the number of cores (%d), 0 to use the pool (default=0)" % multiprocessing.cpu_count(), type="int")
+    parser.add_option("--queue-depth", dest="queueDepth", default=1000,
+        help="number of synthesis jobs allowed to wait before requests are refused with a 503, 0 for no limit (default=1000)", type="int")
+    parser.add_option("--batch-size", dest="batchSize", default=8,
+        help="number of utterances synthesized together in one worker task, 1 to disable batching (default=8)", type="int")
+    parser.add_option("--batch-window", dest="batchWindow", default=0,
+        help="milliseconds new synthesis work waits to batch with more work, 0 to only batch work waiting for a worker (default=0)", type="int")
     parser.add_option("--pid", dest="pid", default=None, type="str",
         help="launch as a daemon and write to the given pid file (default=None)")
     (options, args) = parser.parse_args()
     # run the server
-    run(options.port, options.workers, options.debug, options.static, options.pid)
+    run(options.port, options.workers, options.debug, options.static, 
+        options.pid, options.keepWav, options.memoryCache, options.cacheSize,
+        options.cacheFiles, options.packFiles, options.lazyEncode,
+        options.subprocesses, options.queueDepth, options.batchSize,
+        options.batchWindow)
     
 if __name__ == '__main__':
     run_from_args()
\ No newline at end of file
@@ -0,0 +1,411 @@
+'''
+Pack file storage for small speech files in JSonic. Appends encoded clips
+back to back to large segment files instead of storing each one in its own
+file, and serves them from memory mapped segments.
+
+:requires: Python 2.6, Tornado 1.0
+:copyright: Peter Parente 2010
+:license: BSD
+'''
+import cache
+import tornado.ioloop
+import multiprocessing.pool
+import functools
+import mmap
+import os
+
+# name of the journal recording where files are stored in the segments
+JOURNAL_NAME = 'journal'
+# extension of segment files
+SEGMENT_EXT = '.seg'
+
+class PackSlice(object):
+    '''
+    Read-only file object over the bytes of one file in a memory mapped
+    segment. Reads copy only the requested slice of the mapping.
+
+    :ivar _mm: Memory mapped segment
+    :ivar _offset: Offset of the file in the segment
+    :ivar _size: Size of the file
+    :ivar _pos: Current position relative to the start of the file
+    '''
+    def __init__(self, mm, offset, size):
+        self._mm = mm
+        self._offset = offset
+        self._size = size
+        self._pos = 0
+
+    def seek(self, pos):
+        self._pos = pos
+
+    def read(self, size=-1):
+        end = self._size
+        if size >= 0:
+            end = min(end, self._pos + size)
+        data = self._mm[self._offset+self._pos:self._offset+end]
+        self._pos += len(data)
+        return data
+
+    def close(self):
+        # segments stay mapped until the last reader lets go of them
+        self._mm = None
+
+class PackWriter(object):
+    '''
+    Appends files to segment files and records their locations in the
+    journal. All methods run in the single writer thread of a PackStore.
+
+    :ivar _path: Pack folder path
+    :ivar _segmentBytes: Size at which a new segment is started
+    :ivar _active: Number of the segment being appended to
+    :ivar _journal: Journal file open for appending
+    '''
+    def __init__(self, path, segmentBytes, active):
+        self._path = path
+        self._segmentBytes = segmentBytes
+        self._active = active
+        self._journal = open(os.path.join(path, JOURNAL_NAME), 'ab')
+
+    def _append(self, name, data, mtime):
+        fn = get_segment_path(self._path, self._active)
+        if os.path.isfile(fn) and \
+        os.path.getsize(fn) + len(data) > self._segmentBytes:
+            self._active += 1
+            fn = get_segment_path(self._path, self._active)
+        fh = open(fn, 'ab')
+        try:
+            fh.seek(0, os.SEEK_END)
+            offset = fh.tell()
+            fh.write(data)
+        finally:
+            fh.close()
+        record = (name, self._active, offset, len(data), mtime)
+        self._journal.write('+ %s %d %d %d %d\n' % record)
+        return record
+
+    def append_files(self, cachePath, names):
+        '''
+        Appends loose files from the cache folder to the active segment.
+        Leaves the loose files in place.
+
+        :param cachePath: Path to where synthesized files are stored
+        :type cachePath: str
+        :param names: Filenames relative to the cache folder
+        :type names: list
+        :return: Tuples of (name, segment, offset, size, mtime) for the files
+            appended
+        :rtype: list
+        '''
+        records = []
+        for name in names:
+            fn = cache.find_path(cachePath, name)
+            if fn is None:
+                continue
+            try:
+                fh = open(fn, 'rb')
+                try:
+                    mtime = int(os.fstat(fh.fileno()).st_mtime)
+                    data = fh.read()
+                finally:
+                    fh.close()
+            except (OSError, IOError):
+                continue
+            records.append(self._append(name, data, mtime))
+        self._journal.flush()
+        return records
+
+    def remove_files(self, names):
+        '''
+        Records that files no longer exist in the store.
+
+        :param names: Filenames relative to the cache folder
+        :type names: list
+        '''
+        for name in names:
+            self._journal.write('- %s\n' % name)
+        self._journal.flush()
+
+    def compact(self, segment, entries):
+        '''
+        Copies the live files of a segment to the active segment. The old
+        segment must be deleted once no new readers can open it.
+
+        :param segment: Number of the segment to compact
+        :type segment: int
+        :param entries: Tuples of (name, offset, size, mtime) of the live files
+            in the segment
+        :type entries: list
+        :return: Tuples of (name, segment, offset, size, mtime) for the files
+            copied
+        :rtype: list
+        '''
+        if segment == self._active:
+            self._active += 1
+        fn = get_segment_path(self._path, segment)
+        records = []
+        fh = open(fn, 'rb')
+        try:
+            for name, offset, size, mtime in entries:
+                fh.seek(offset)
+                records.append(self._append(name, fh.read(size), mtime))
+        finally:
+            fh.close()
+        self._journal.flush()
+        return records
+
+def get_segment_path(path, segment):
+    '''
+    :param path: Pack folder path
+    :type path: str
+    :param segment: Segment number
+    :type segment: int
+    :return: Path of the segment file
+    :rtype: str
+    '''
+    return os.path.join(path, '%08d%s' % (segment, SEGMENT_EXT))
+
+class PackStore(object):
+    '''
+    Stores small speech files in large append-only segment files. Loose
+    files written by the workers are appended to the active segment in the
+    background and then removed from the cache folder. Removed files only
+    leave dead bytes in their segment until the segment is compacted.
+
+    All methods must be called on the IOLoop thread. Disk writes happen in a
+    single writer thread.
+
+    :ivar _path: Pack folder path
+    :ivar _cachePath: Cache folder path
+    :ivar _ioPool: Thread pool for removing loose files
+    :ivar maxItemBytes: Largest file stored in the pack
+    :ivar _entries: Filenames paired with tuples of (segment, offset, size,
+        mtime)
+    :ivar _live: Segment numbers paired with bytes of live files in them
+    :ivar _total: Segment numbers paired with bytes of all files in them
+    :ivar _maps: Segment numbers paired with their memory mappings
+    :ivar _pending: Names of files being appended
+    :ivar _writer: PackWriter used from the writer thread
+    :ivar _writerPool: Single thread pool for all writes
+    :cvar SEGMENT_BYTES: Size at which a new segment is started
+    :cvar COMPACT_RATIO: Fraction of live bytes below which a segment is
+        compacted
+    '''
+    SEGMENT_BYTES = 64 * 1024 * 1024
+    COMPACT_RATIO = 0.5
+
+    def __init__(self, path, cachePath, ioPool, maxItemBytes):
+        '''
+        Constructor. Loads the journal and rewrites it without removed
+        entries.
+
+        :param path: Pack folder path
+        :type path: str
+        :param cachePath: Path to where synthesized files are stored
+        :type cachePath: str
+        :param ioPool: Thread pool for removing loose files
+        :type ioPool: multiprocessing.pool.ThreadPool
+        :param maxItemBytes: Largest file stored in the pack
+        :type maxItemBytes: int
+        '''
+        self._path = path
+        self._cachePath = cachePath
+        self._ioPool = ioPool
+        self.maxItemBytes = maxItemBytes
+        self._entries = {}
+        self._live = {}
+        self._total = {}
+        self._maps = {}
+        self._pending = set()
+        try:
+            os.makedirs(path)
+        except OSError:
+            pass
+        self._load()
+        active = max([0] + self._total.keys())
+        self._writer = PackWriter(path, self.SEGMENT_BYTES, active + 1)
+        self._writerPool = multiprocessing.pool.ThreadPool(processes=1)
+
+    def _load(self):
+        fn = os.path.join(self._path, JOURNAL_NAME)
+        sizes = {}
+        for name in os.listdir(self._path):
+            if name.endswith(SEGMENT_EXT):
+                segment = int(name[:-len(SEGMENT_EXT)])
+                sizes[segment] = os.path.getsize(os.path.join(self._path,
+                    name))
+                self._total[segment] = sizes[segment]
+                self._live[segment] = 0
+        if os.path.isfile(fn):
+            fh = open(fn, 'rb')
+            try:
+                for line in fh:
+                    fields = line.split()
+                    if len(fields) == 6 and fields[0] == '+':
+                        record = tuple([int(f) for f in fields[2:]])
+                        segment, offset, size, mtime = record
+                        # ignore appends lost in a crash
+                        if offset + size <= sizes.get(segment, -1):
+                            self._entries[fields[1]] = record
+                    elif len(fields) == 2 and fields[0] == '-':
+                        self._entries.pop(fields[1], None)
+            finally:
+                fh.close()
+        for segment, offset, size, mtime in self._entries.itervalues():
+            self._live[segment] += size
+        for segment, live in self._live.items():
+            if not live:
+                # nothing left worth keeping in this segment
+                os.remove(get_segment_path(self._path, segment))
+                del self._live[segment]
+                del self._total[segment]
+        # start a compact journal
+        tmp = cache.get_temp_path(fn)
+        fh = open(tmp, 'wb')
+        try:
+            for name, record in self._entries.iteritems():
+                fh.write('+ %s %d %d %d %d\n' % ((name,) + record))
+        finally:
+            fh.close()
+        os.rename(tmp, fn)
+
+    def __contains__(self, name):
+        return name in self._entries
+
+    def iter_sizes(self):
+        '''
+        :return: Iterator over tuples of (filename, size) for all stored files
+        :rtype: iterator
+        '''
+        for name, record in self._entries.iteritems():
+            yield name, record[2]
+
+    def open(self, name):
+        '''
+        Opens a stored file for reading.
+
+        :param name: Filename relative to the cache folder
+        :type name: str
+        :return: Tuple of (PackSlice, size, mtime) or None if the file is not
+            in the store
+        :rtype: tuple
+        '''
+        record = self._entries.get(name)
+        if record is None:
+            return None
+        segment, offset, size, mtime = record
+        mm = self._maps.get(segment)
+        if mm is None or len(mm) < offset + size:
+            # map the segment again if it has grown since it was last mapped
+            fh = open(get_segment_path(self._path, segment), 'rb')
+            try:
+                mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+            finally:
+                fh.close()
+            self._maps[segment] = mm
+        return PackSlice(mm, offset, size), size, mtime
+
+    def add(self, names):
+        '''
+        Moves loose files from the cache folder into the store in the
+        background.
+
+        :param names: Filenames relative to the cache folder
+        :type names: list
+        '''
+        names = [name for name in names
+            if name not in self._entries and name not in self._pending]
+        if not names:
+            return
+        self._pending.update(names)
+        self._writerPool.apply_async(self._writer.append_files,
+            (self._cachePath, names),
+            callback=self._in_loop(functools.partial(self._on_added, names)))
+
+    def remove(self, names):
+        '''
+        Removes files from the store and compacts segments that have become
+        mostly dead.
+
+        :param names: Filenames relative to the cache folder
+        :type names: list
+        '''
+        segments = set()
+        removed = []
+        for name in names:
+            self._pending.discard(name)
+            record = self._entries.pop(name, None)
+            if record is not None:
+                self._live[record[0]] -= record[2]
+                segments.add(record[0])
+                removed.append(name)
+        if removed:
+            self._writerPool.apply_async(self._writer.remove_files, 
+                (removed,))
+        for segment in segments:
+            total = self._total[segment]
+            if total and self._live[segment] < total * self.COMPACT_RATIO:
+                self._compact(segment)
+
+    def get_stats(self):
+        '''
+        :return: Counters describing the store
+        :rtype: dict
+        '''
+        return {
+            'files' : len(self._entries),
+            'segments' : len(self._total),
+            'bytes' : sum(self._total.values()),
+            'live_bytes' : sum(self._live.values())
+        }
+
+    def _compact(self, segment):
+        entries = [(name, record[1], record[2], record[3])
+            for name, record in self._entries.iteritems()
+            if record[0] == segment]
+        # never compact the same segment twice
+        self._total[segment] = 0
+        self._writerPool.apply_async(self._writer.compact, (segment, entries),
+            callback=self._in_loop(functools.partial(self._on_compacted,
+                segment)))
+
+    def _in_loop(self, callback):
+        # wrap a pool callback to run on the IOLoop thread
+        loop = tornado.ioloop.IOLoop.instance()
+        return lambda result: loop.add_callback(
+            functools.partial(callback, result))
+
+    def _record(self, records, segment=None):
+        dropped = []
+        for name, seg, offset, size, mtime in records:
+            self._total[seg] = self._total.get(seg, 0) + size
+            self._live.setdefault(seg, 0)
+            old = self._entries.get(name)
+            if segment is None and name not in self._pending:
+                # removed while being appended, leave its copy dead
+                dropped.append(name)
+                continue
+            if segment is not None and (old is None or old[0] != segment):
+                # removed during compaction, leave its copy dead
+                continue
+            if old is not None:
+                self._live[old[0]] -= old[2]
+            self._entries[name] = (seg, offset, size, mtime)
+            self._live[seg] += size
+        if dropped:
+            self._writerPool.apply_async(self._writer.remove_files, (dropped,))
+
+    def _on_added(self, names, records):
+        self._record(records)
+        self._pending.difference_update(names)
+        # the loose files are no longer needed
+        self._ioPool.apply_async(cache.remove_files, (self._cachePath, 
+            [record[0] for record in records if record[0] in self._entries]))
+
+    def _on_compacted(self, segment, records):
+        self._record(records, segment)
+        del self._total[segment]
+        del self._live[segment]
+        # mapped readers keep the old data alive until they finish
+        self._maps.pop(segment, None)
+        self._ioPool.apply_async(os.remove, 
+            (get_segment_path(self._path, segment),))
@@ -0,0 +1,574 @@
+'''
+Runs speech engine and encoder commands as children of the server process
+without blocking the Tornado IOLoop.
+
+:requires: Python 2.6, Tornado 1.1
+:copyright: Peter Parente 2010
+:license: BSD
+'''
+import cache
+import encoder
+import synthesizer
+import tornado.ioloop
+import collections
+import subprocess
+import functools
+import fcntl
+import errno
+import time
+import os
+
+def set_nonblocking(fd):
+    '''
+    Puts a file descriptor in non-blocking mode.
+
+    :param fd: File descriptor
+    :type fd: int
+    '''
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+def write_output(fh, data):
+    '''
+    Appends output of a pipeline to its temporary file. Meant to run in the
+    I/O thread pool.
+
+    :param fh: Temporary file object
+    :type fh: file
+    :param data: Bytes to append
+    :type data: str
+    :return: None on success or a developer-readable explanation of why
+        writing failed
+    :rtype: str
+    '''
+    try:
+        fh.write(data)
+    except (IOError, ValueError), e:
+        return 'could not write %s' % e
+
+def close_output(fh, tmp, fn):
+    '''
+    Closes the temporary file of a pipeline and moves it into place, or
+    removes it if fn is None. Meant to run in the I/O thread pool.
+
+    :param fh: Temporary file object
+    :type fh: file
+    :param tmp: Temporary path of the output file
+    :type tmp: str
+    :param fn: Final path of the output file or None to discard it
+    :type fn: str
+    :return: None on success or a developer-readable explanation of why
+        moving the file failed
+    :rtype: str
+    '''
+    try:
+        fh.close()
+        if fn is not None:
+            os.rename(tmp, fn)
+            return None
+    except (IOError, OSError), e:
+        description = 'could not write %s' % e
+    else:
+        description = None
+    try:
+        os.remove(tmp)
+    except OSError:
+        pass
+    return description
+
+class Pipeline(object):
+    '''
+    Pipes input through a chain of commands, typically a speech engine and
+    an encoder. Hands the output of the last command to a callback as it is
+    produced while writing it to a temporary file that is moved into place
+    in the cache folder when all commands succeed. Writes to the file run in
+    the I/O thread pool one at a time and in order.
+
+    All methods must be called on the IOLoop thread. Callbacks are always
+    invoked on the IOLoop thread.
+
+    :ivar _commands: Command lines in pipe order
+    :ivar _input: Bytes not yet written to the first command or a file
+        object to connect to its stdin
+    :ivar _fn: Final path of the output file
+    :ivar _tmp: Temporary path of the output file
+    :ivar _ioPool: Thread pool for disk access
+    :ivar _out: Temporary file object
+    :ivar _pending: Output not yet handed to the thread pool
+    :ivar _writing: True while a write runs in the thread pool
+    :ivar _exited: True once all commands exited successfully
+    :ivar _procs: subprocess.Popen objects in pipe order
+    :ivar _fds: File descriptors registered with the IOLoop
+    :ivar _onChunk: Invoked with each string of output or None
+    :ivar _onDone: Invoked once when the pipeline ends
+    :ivar _done: True after _onDone is invoked or the pipeline failed
+    :cvar CHUNK_SIZE: Maximum bytes to read from the last command at once
+    :cvar POLL_INTERVAL: Seconds between checks for the commands exiting after
+        the last one closes its output
+    '''
+    CHUNK_SIZE = 64 * 1024
+    POLL_INTERVAL = 0.01
+
+    def __init__(self, commands, input, fn, ioPool, onChunk, onDone):
+        '''
+        Constructor.
+
+        :param commands: Command lines in pipe order, each reading from stdin
+            and writing to stdout, such as those returned by 
+            ISynthesizer.get_wav_command and IEncoder.get_encode_command
+        :type commands: list
+        :param input: Bytes to write to the first command, such as UTF-8 
+            text, or a file object to read them from
+        :type input: str
+        :param fn: Final path of the output file in the cache folder
+        :type fn: str
+        :param ioPool: Thread pool for disk access
+        :type ioPool: multiprocessing.pool.ThreadPool
+        :param onChunk: Invoked as onChunk(data) with each string of output
+            in order or None to only write the file
+        :type onChunk: callable
+        :param onDone: Invoked as onDone(description) once the file is in
+            place where description is None, or once the pipeline fails where
+            description is a developer-readable explanation of the failure
+        :type onDone: callable
+        '''
+        self._commands = commands
+        self._input = input
+        self._fn = fn
+        self._tmp = cache.get_temp_path(fn)
+        self._ioPool = ioPool
+        self._out = None
+        self._pending = []
+        self._writing = False
+        self._exited = False
+        self._procs = []
+        self._fds = []
+        self._onChunk = onChunk
+        self._onDone = onDone
+        self._done = False
+
+    def start(self):
+        '''
+        Launches the commands.
+        '''
+        feed = isinstance(self._input, str)
+        try:
+            self._out = open(self._tmp, 'wb')
+            stdin = feed and subprocess.PIPE or self._input
+            for args in self._commands:
+                p = subprocess.Popen(args, stdin=stdin, 
+                    stdout=subprocess.PIPE, close_fds=True)
+                if self._procs:
+                    # only the next command reads the previous output
+                    self._procs[-1].stdout.close()
+                self._procs.append(p)
+                stdin = p.stdout
+        except (IOError, OSError), e:
+            self._fail('could not start %s' % e)
+            return
+        finally:
+            if not feed:
+                self._input.close()
+        loop = tornado.ioloop.IOLoop.instance()
+        handlers = [(self._procs[-1].stdout, self._on_readable, loop.READ)]
+        if feed:
+            handlers.append((self._procs[0].stdin, self._on_writable, 
+                loop.WRITE))
+        for fh, handler, events in handlers:
+            fd = fh.fileno()
+            set_nonblocking(fd)
+            loop.add_handler(fd, handler, events | loop.ERROR)
+            self._fds.append(fd)
+
+    def kill(self):
+        '''
+        Terminates the commands and removes the temporary file. Does not
+        invoke onChunk again. Invokes onDone if the pipeline has not ended
+        already.
+        '''
+        self._fail('synthesis cancelled')
+
+    def _on_writable(self, fd, events):
+        try:
+            sent = os.write(fd, self._input)
+        except OSError, e:
+            if e.errno == errno.EAGAIN:
+                return
+            # the command exited early, let its exit code tell why
+            sent = len(self._input)
+        self._input = self._input[sent:]
+        if not self._input:
+            self._close_fd(fd)
+            self._procs[0].stdin.close()
+
+    def _on_readable(self, fd, events):
+        try:
+            data = os.read(fd, self.CHUNK_SIZE)
+        except OSError, e:
+            if e.errno == errno.EAGAIN:
+                return
+            data = ''
+        if data:
+            self._pending.append(data)
+            self._write()
+            if self._onChunk is not None:
+                self._onChunk(data)
+            return
+        # the last command closed its output
+        self._close_fd(fd)
+        self._procs[-1].stdout.close()
+        self._reap()
+
+    def _reap(self):
+        if self._done:
+            return
+        codes = [p.poll() for p in self._procs]
+        if None in codes:
+            loop = tornado.ioloop.IOLoop.instance()
+            loop.add_timeout(time.time() + self.POLL_INTERVAL, self._reap)
+            return
+        for args, code in zip(self._commands, codes):
+            if code != 0:
+                self._fail('%s failed with exit code %s' % (args[0], code))
+                return
+        self._exited = True
+        self._write()
+
+    def _write(self):
+        # one write at a time keeps the output in order
+        if self._writing:
+            return
+        if self._pending:
+            data = ''.join(self._pending)
+            self._pending = []
+            self._submit(write_output, (self._out, data), self._on_written)
+        elif self._exited:
+            self._submit(close_output, (self._out, self._tmp, self._fn),
+                self._on_closed)
+
+    def _submit(self, func, args, callback):
+        self._writing = True
+        loop = tornado.ioloop.IOLoop.instance()
+        self._ioPool.apply_async(func, args, callback=lambda result: 
+            loop.add_callback(functools.partial(callback, result)))
+
+    def _on_written(self, description):
+        self._writing = False
+        if self._done:
+            # the pipeline failed while writing, discard the file
+            self._submit(close_output, (self._out, self._tmp, None),
+                self._on_discarded)
+        elif description is not None:
+            self._fail(description)
+        else:
+            self._write()
+
+    def _on_closed(self, description):
+        self._writing = False
+        if description is not None:
+            # the file is gone already
+            self._out = None
+            self._fail(description)
+            return
+        self._done = True
+        self._onDone(None)
+
+    def _on_discarded(self, description):
+        self._writing = False
+        self._out = None
+
+    def _close_fd(self, fd):
+        tornado.ioloop.IOLoop.instance().remove_handler(fd)
+        self._fds.remove(fd)
+
+    def _fail(self, description):
+        if self._done:
+            return
+        self._done = True
+        for fd in list(self._fds):
+            self._close_fd(fd)
+        for p in self._procs:
+            if p.poll() is None:
+                try:
+                    p.kill()
+                except OSError:
+                    pass
+                p.wait()
+            for fh in (p.stdin, p.stdout):
+                if fh is not None:
+                    fh.close()
+        # a write in flight discards the file once it ends
+        if self._out is not None and not self._writing:
+            self._submit(close_output, (self._out, self._tmp, None),
+                self._on_discarded)
+        self._onDone(description)
+
+class ProcessLimiter(object):
+    '''
+    Semaphore capping the number of pipelines running at once. Callers
+    waiting for a slot are started in the order they asked.
+
+    All methods must be called on the IOLoop thread.
+
+    :ivar limit: Maximum number of pipelines running at once
+    :ivar _running: Number of slots in use
+    :ivar _waiting: Callbacks waiting for a slot
+    '''
+    def __init__(self, limit):
+        '''
+        Constructor.
+
+        :param limit: Maximum number of pipelines running at once
+        :type limit: int
+        '''
+        self.limit = limit
+        self._running = 0
+        self._waiting = collections.deque()
+
+    def is_full(self):
+        '''
+        :return: True if no slot is free
+        :rtype: bool
+        '''
+        return self._running >= self.limit
+
+    def acquire(self, callback):
+        '''
+        Invokes a callback once a slot is free. The callback must call
+        release when its pipeline ends.
+
+        :param callback: Invoked with no arguments
+        :type callback: callable
+        '''
+        if self._running < self.limit:
+            self._running += 1
+            callback()
+        else:
+            self._waiting.append(callback)
+
+    def cancel(self, callback):
+        '''
+        Withdraws a callback still waiting for a slot.
+
+        :param callback: Callback passed to acquire
+        :type callback: callable
+        :return: True if the callback was waiting and will not be invoked or
+            False if it already has a slot
+        :rtype: bool
+        '''
+        try:
+            self._waiting.remove(callback)
+        except ValueError:
+            return False
+        return True
+
+    def release(self):
+        '''
+        Frees a slot taken by acquire, passing it to the next waiting caller
+        if any.
+        '''
+        if self._waiting:
+            self._waiting.popleft()()
+        else:
+            self._running -= 1
+
+    def get_stats(self):
+        '''
+        :return: Counters describing the slots
+        :rtype: dict
+        '''
+        return {
+            'running' : self._running,
+            'waiting' : len(self._waiting),
+            'limit' : self.limit
+        }
+
+class PipelineTask(object):
+    '''
+    Pipeline run by a PipelineExecutor once the ProcessLimiter has a slot for
+    it. Can be killed whether it is still waiting for a slot or running.
+
+    All methods must be called on the IOLoop thread. Callbacks are always
+    invoked on the IOLoop thread.
+
+    :ivar _limiter: ProcessLimiter shared by all pipelines
+    :ivar _commands: Command lines in pipe order
+    :ivar _input: Bytes to write to the first command or None
+    :ivar _wav: Path of a file to connect to the stdin of the first command
+        or None
+    :ivar _fn: Final path of the output file
+    :ivar _ioPool: Thread pool for disk access
+    :ivar _callback: Invoked once when the task ends
+    :ivar _pipeline: Pipeline once the task has a slot or None
+    '''
+    def __init__(self, limiter, commands, input, wav, fn, ioPool, callback):
+        '''
+        Constructor.
+
+        :param limiter: Semaphore capping the number of pipelines
+        :type limiter: ProcessLimiter
+        :param commands: Command lines in pipe order
+        :type commands: list
+        :param input: Bytes to write to the first command or None to read
+            them from wav
+        :type input: str
+        :param wav: Path of the file to read from when input is None
+        :type wav: str
+        :param fn: Final path of the output file in the cache folder
+        :type fn: str
+        :param ioPool: Thread pool for disk access
+        :type ioPool: multiprocessing.pool.ThreadPool
+        :param callback: Invoked as callback(description) once the file is in
+            place where description is None, or once the task fails or is 
+            killed where description is a developer-readable explanation
+        :type callback: callable
+        '''
+        self._limiter = limiter
+        self._commands = commands
+        self._input = input
+        self._wav = wav
+        self._fn = fn
+        self._ioPool = ioPool
+        self._callback = callback
+        self._pipeline = None
+
+    def start(self):
+        '''
+        Runs the pipeline as soon as the limiter has a slot.
+        '''
+        self._limiter.acquire(self._run)
+
+    def kill(self):
+        '''
+        Drops the task if it is waiting for a slot or terminates its commands
+        if it is running. Invokes the callback if the task has not ended
+        already.
+        '''
+        if self._pipeline is not None:
+            self._pipeline.kill()
+        elif self._limiter.cancel(self._run):
+            self._callback('synthesis cancelled')
+
+    def _run(self):
+        input = self._input
+        if input is None:
+            try:
+                input = open(self._wav, 'rb')
+            except IOError, e:
+                self._limiter.release()
+                self._callback(str(e))
+                return
+        self._pipeline = Pipeline(self._commands, input, self._fn, 
+            self._ioPool, None, self._on_done)
+        self._pipeline.start()
+
+    def _on_done(self, description):
+        self._limiter.release()
+        self._callback(description)
+
+class PipelineExecutor(object):
+    '''
+    Synthesizes and encodes files by running engine and encoder commands as
+    supervised children of the server process instead of in pool workers.
+    Holds no Python process per job so far more jobs can run at once.
+
+    All methods must be called on the IOLoop thread. Callbacks are always
+    invoked on the IOLoop thread.
+
+    :ivar _path: Cache folder path
+    :ivar _limiter: ProcessLimiter shared by all pipelines
+    :ivar _ioPool: Thread pool for disk access
+    '''
+    def __init__(self, path, limiter, ioPool):
+        '''
+        Constructor.
+
+        :param path: Path to where synthesized files are stored
+        :type path: str
+        :param limiter: Semaphore capping the number of pipelines
+        :type limiter: ProcessLimiter
+        :param ioPool: Thread pool for disk access
+        :type ioPool: multiprocessing.pool.ThreadPool
+        '''
+        self._path = path
+        self._limiter = limiter
+        self._ioPool = ioPool
+
+    def synthesize(self, engineCls, encoderCls, format, properties, hashFn,
+    text, profile, callback):
+        '''
+        Synthesizes and encodes an utterance if the engine and encoder can
+        run as commands.
+
+        :param engineCls: ISynthesizer implementation to use for synth
+        :type engineCls: class
+        :param encoderCls: IEncoder implementation to use for encoding or
+            None to only write the WAV file
+        :type encoderCls: class
+        :param format: Encoder format extension with the prefix `.`,
+            including the profile name if any, .wav if encoderCls is None
+        :type format: str
+        :param properties: Properties to use when synthesizing
+        :type properties: dict
+        :param hashFn: Root name of the file as returned by
+            ISynthesizer.get_hash
+        :type hashFn: str
+        :param text: Unicode utterance to synthesize
+        :type text: unicode
+        :param profile: Name of the encoder quality profile or None
+        :type profile: str
+        :param callback: Invoked as callback(description) where description
+            is None on success or a developer-readable explanation of why
+            synthesis failed
+        :type callback: callable
+        :return: Task that may be killed to cancel the work, None if the work
+            must run in a pool worker instead, or False if it failed already 
+            and callback was invoked
+        :rtype: PipelineTask
+        '''
+        try:
+            commands = [engineCls(self._path, properties).get_wav_command()]
+            if encoderCls is not None:
+                commands.append(encoderCls(self._path, profile)
+                    .get_encode_command())
+        except (synthesizer.SynthesizerError, encoder.EncoderError), e:
+            callback(str(e))
+            return False
+        if None in commands:
+            return None
+        fn = cache.make_path(self._path, hashFn + format)
+        task = PipelineTask(self._limiter, commands, text.encode('utf-8'),
+            None, fn, self._ioPool, callback)
+        task.start()
+        return task
+
+    def encode(self, encoderCls, format, hashFn, profile, callback):
+        '''
+        Encodes a WAV file already in the cache folder.
+
+        :param encoderCls: IEncoder implementation to use for encoding
+        :type encoderCls: class
+        :param format: Encoder format extension with the prefix `.`,
+            including the profile name if any
+        :type format: str
+        :param hashFn: Root name of the WAV file
+        :type hashFn: str
+        :param profile: Name of the encoder quality profile or None
+        :type profile: str
+        :param callback: Invoked like the callback of synthesize
+        :type callback: callable
+        :return: Task that may be killed to cancel the work or False if it 
+            failed already and callback was invoked
+        :rtype: PipelineTask
+        '''
+        try:
+            commands = [encoderCls(self._path, profile).get_encode_command()]
+        except encoder.EncoderError, e:
+            callback(str(e))
+            return False
+        fn = cache.make_path(self._path, hashFn + format)
+        wav = cache.get_path(self._path, hashFn + '.wav')
+        task = PipelineTask(self._limiter, commands, None, wav, fn, 
+            self._ioPool, callback)
+        task.start()
+        return task
@@ -0,0 +1,61 @@
+'''
+Moves speech files from the top level of a JSonic cache folder into the
+sharded subfolder layout used by the server. Safe to run while the server is
+serving the cache: files are moved with atomic renames and the server looks
+for files at the top level when they are not in their subfolder yet.
+
+:requires: Python 2.6
+:copyright: Peter Parente 2010
+:license: BSD
+'''
+import cache
+import optparse
+import logging
+import os
+import re
+
+# names of cache files, including any left by --keep-wav
+CACHE_FILE_RX = re.compile(r'^[a-f0-9]+-[a-f0-9]+\..+$')
+
+def reshard(path):
+    '''
+    Moves all speech files at the top level of the cache folder into their
+    subfolders.
+
+    :param path: Path to where synthesized files are stored
+    :type path: str
+    :return: Number of files moved
+    :rtype: int
+    '''
+    moved = 0
+    for name in os.listdir(path):
+        src = os.path.join(path, name)
+        if not CACHE_FILE_RX.match(name) or not os.path.isfile(src):
+            continue
+        dest = cache.make_path(path, name)
+        if os.path.isfile(dest):
+            # a worker already wrote the file in its subfolder
+            os.remove(src)
+        else:
+            os.rename(src, dest)
+        moved += 1
+        if moved % 10000 == 0:
+            logging.info('Moved %d files', moved)
+    return moved
+
+def run_from_args():
+    '''
+    Reshards a cache folder named on the command line.
+    '''
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option("--path", dest="path",
+        default=os.path.join(os.path.dirname(__file__), 'files'),
+        help="cache folder to reshard (default=./files)", type="str")
+    (options, args) = parser.parse_args()
+    logging.basicConfig(level=logging.INFO,
+                format='%(asctime)s %(levelname)s %(message)s')
+    moved = reshard(options.path)
+    logging.info('Moved %d files into subfolders', moved)
+
+if __name__ == '__main__':
+    run_from_args()
@@ -0,0 +1,606 @@
+'''
+Synthesis job scheduling for JSonic.
+
+:requires: Python 2.6, Tornado 1.1
+:copyright: Peter Parente 2010
+:license: BSD
+'''
+import tornado.ioloop
+import collections
+import functools
+import logging
+import math
+import time
+
+# description passed to callbacks of work the queue had no room for
+BUSY = 'server busy'
+# description of work dropped because no client waits on it anymore
+CANCELLED = 'synthesis cancelled'
+# priority classes of work, the first always runs first unless work of the
+# second has waited too long
+INTERACTIVE = 'interactive'
+PREFETCH = 'prefetch'
+PRIORITIES = (INTERACTIVE, PREFETCH)
+
+class SynthJob(object):
+    '''
+    Unit of work queued by the SynthScheduler.
+
+    :ivar kind: 'synth' to synthesize and encode or 'encode' to encode a WAV
+        file already in the cache
+    :ivar engineCls: ISynthesizer implementation or None for encode jobs
+    :ivar encoderCls: IEncoder implementation or None to only write WAVs
+    :ivar format: Encoder format extension with the prefix `.`, including
+        the profile name if any
+    :ivar properties: Properties to use when synthesizing
+    :ivar profile: Name of the encoder quality profile or None
+    :ivar texts: Root names of the cache files produced by the job paired
+        with the unicode utterances to synthesize into them, None for encode
+        jobs, possibly collected from many requests
+    :ivar priority: INTERACTIVE or PREFETCH
+    :ivar enqueued: Time the job was queued
+    :ivar started: Time the job was dispatched or None if it is queued
+    :ivar task: pipeline.PipelineTask or workers.WorkerTask running the job
+        or None if it is queued
+    :ivar batchKey: Key of the batch the job collects texts for or None
+    '''
+    def __init__(self, kind, engineCls, encoderCls, format, properties,
+    profile, texts, priority=INTERACTIVE):
+        self.kind = kind
+        self.engineCls = engineCls
+        self.encoderCls = encoderCls
+        self.format = format
+        self.properties = properties
+        self.profile = profile
+        self.texts = texts
+        self.priority = priority
+        self.enqueued = time.time()
+        self.started = None
+        self.task = None
+        self.batchKey = None
+
+class SynthScheduler(object):
+    '''
+    Queues synthesis work on behalf of all requests and dispatches it to the
+    worker pool or the pipeline executor as slots free up. Coalesces requests
+    for the same cache file so that it is synthesized and encoded at most
+    once at a time no matter how many clients ask for it. Refuses new work
+    when the queue is full so that overload sheds requests instead of
+    growing the backlog without bound.
+
+    Interactive jobs always run before prefetch jobs so that speech a user
+    is waiting to hear is not stuck behind speech fetched ahead of time.
+    Prefetch jobs run when no interactive jobs wait or once they have waited
+    longer than AGING seconds so that they cannot starve.
+
+    Synthesis jobs for the pool with the same engine, properties, format,
+    and priority are batched into one pool task while they wait so that
+    concurrent requests share the cost of sending the task to a worker and
+    setting up the engine and encoder there. A batching window holds new
+    jobs back briefly so that batches can form before slots are free.
+
+    Among the first LOOKAHEAD jobs of a priority class, a job whose engine
+    and voice are warm on an idle worker runs first so that workers keep
+    synthesizing with the voices they have loaded.
+
+    All methods must be called on the IOLoop thread. Callbacks are always
+    invoked on the IOLoop thread.
+
+    :ivar _pool: workers.WorkerPool of processes
+    :ivar _func: Function to run in the pool with the signature of
+        jsonic.synthesize
+    :ivar _slots: Number of jobs to run at once
+    :ivar _index: cache.CacheIndex to update as files are written
+    :ivar _flights: Cache filenames being synthesized paired with lists of
+        callbacks waiting on them
+    :ivar _jobs: Cache filenames paired with the SynthJobs producing them
+    :ivar _encodeFunc: Function to run in the pool with the signature of
+        jsonic.encode or None
+    :ivar _executor: pipeline.PipelineExecutor running work as commands
+        supervised by the IOLoop or None to run all work in the pool
+    :ivar maxDepth: Most jobs allowed to wait in the queue or zero for no
+        limit
+    :ivar _queues: Priority classes paired with deques of SynthJobs
+        waiting for a slot in order
+    :ivar _running: Number of jobs dispatched and not yet done
+    :ivar _serviceTime: Moving average of seconds a job takes to run
+    :ivar batchSize: Most utterances synthesized in one pool task
+    :ivar batchWindow: Seconds a new synthesis job waits for more utterances
+        to batch with it
+    :ivar _batches: Batch keys paired with queued SynthJobs that can take
+        more utterances
+    :ivar _timeout: IOLoop timeout dispatching held jobs or None
+    :ivar rejected: Number of jobs refused because the queue was full
+    :ivar cancelled: Number of jobs dropped or killed because no callbacks
+        waited on them anymore
+    :cvar SERVICE_TIME: Initial guess of seconds a job takes to run
+    :cvar SERVICE_WEIGHT: Weight of the latest job in the moving average
+    :cvar AGING: Seconds a prefetch job waits before it runs ahead of
+        interactive jobs
+    :cvar LOOKAHEAD: Jobs at the head of a queue considered for running on
+        a warm worker
+    '''
+    SERVICE_TIME = 1.0
+    SERVICE_WEIGHT = 0.2
+    AGING = 5.0
+    LOOKAHEAD = 8
+
+    def __init__(self, pool, func, slots, index, encodeFunc=None,
+    executor=None, maxDepth=0, batchSize=1, batchWindow=0):
+        '''
+        Constructor.
+
+        :param pool: Pool of workers
+        :type pool: workers.WorkerPool
+        :param func: Function to run in the pool with the signature of
+            jsonic.synthesize
+        :type func: callable
+        :param slots: Number of jobs to run at once, typically the number of
+            workers in the pool or pipelines allowed by the executor
+        :type slots: int
+        :param index: Index of files in the cache folder
+        :type index: cache.CacheIndex
+        :param encodeFunc: Function to run in the pool with the signature of
+            jsonic.encode or None if encode is never called
+        :type encodeFunc: callable
+        :param executor: Executor to run work with when the engine and
+            encoder can run as commands or None to run all work in the pool
+        :type executor: pipeline.PipelineExecutor
+        :param maxDepth: Most jobs allowed to wait in the queue or zero for
+            no limit
+        :type maxDepth: int
+        :param batchSize: Most utterances synthesized in one pool task, one
+            to disable batching. Batching is disabled when executor is set.
+        :type batchSize: int
+        :param batchWindow: Seconds a new synthesis job waits for more 
+            utterances to batch with it before it runs, zero to only batch
+            jobs that wait for a slot anyway
+        :type batchWindow: float
+        '''
+        self._pool = pool
+        self._func = func
+        self._slots = slots
+        self._index = index
+        self._flights = {}
+        self._jobs = {}
+        self._encodeFunc = encodeFunc
+        self._executor = executor
+        self.maxDepth = maxDepth
+        self._queues = dict((priority, collections.deque()) 
+            for priority in PRIORITIES)
+        self._running = 0
+        self._serviceTime = self.SERVICE_TIME
+        if executor is not None:
+            # pipelines run one utterance each
+            batchSize = 1
+        self.batchSize = batchSize
+        self.batchWindow = batchSize > 1 and batchWindow or 0
+        self._batches = {}
+        self._timeout = None
+        self.rejected = 0
+        self.cancelled = 0
+
+    def synthesize(self, engineCls, encoderCls, format, properties, texts,
+    callback, profile=None, priority=INTERACTIVE):
+        '''
+        Synthesizes and encodes utterances that are not yet in the cache.
+        Utterances already being synthesized for another request are not
+        queued again, but queued prefetch jobs are promoted when an 
+        interactive request waits on them.
+
+        :param engineCls: ISynthesizer implementation to use for synth
+        :type engineCls: class
+        :param encoderCls: IEncoder implementation to use for encoding or
+            None to only write WAV files
+        :type encoderCls: class
+        :param format: Encoder format extension with the prefix `.`,
+            including the profile name if any, .wav if encoderCls is None
+        :type format: str
+        :param properties: Properties to use when synthesizing
+        :type properties: dict
+        :param texts: Root names of cache files as returned by
+            ISynthesizer.get_hash paired with the unicode utterances to
+            synthesize into them
+        :type texts: dict
+        :param callback: Invoked once per root name as callback(hashFn,
+            description) where description is None on success or a
+            developer-readable explanation of why synthesis failed
+        :type callback: callable
+        :param profile: Name of the encoder quality profile or None
+        :type profile: str
+        :param priority: INTERACTIVE for speech a user is waiting on or 
+            PREFETCH for speech fetched ahead of time
+        :type priority: str
+        :return: True if callback will be invoked for every root name or
+            False if the queue has no room for the work and callback will
+            never be invoked
+        :rtype: bool
+        '''
+        fresh = {}
+        waiting = []
+        evicting = []
+        for hashFn, text in texts.items():
+            name = hashFn + format
+            if name in self._flights:
+                waiting.append(name)
+            elif self._index.is_evicting(name):
+                evicting.append(hashFn)
+            else:
+                fresh[hashFn] = text
+        if self.is_full(len(fresh)):
+            self.rejected += len(fresh)
+            return False
+        for name in waiting:
+            self._flights[name].append(callback)
+            if priority == INTERACTIVE:
+                self._promote(name)
+        for hashFn in evicting:
+            # wait until eviction has removed the old files from disk
+            self._index.after_eviction(hashFn + format, functools.partial(
+                self._retry, self.synthesize, [hashFn], callback, engineCls,
+                encoderCls, format, properties, {hashFn : texts[hashFn]},
+                callback, profile, priority))
+        for hashFn, text in fresh.items():
+            name = hashFn + format
+            self._flights[name] = [callback]
+            # keep other files of the group on disk while encoding
+            self._index.pin(name)
+            # dispatch one at a time to fan out across free slots and only
+            # batch what must wait
+            self._enqueue(SynthJob('synth', engineCls, encoderCls, format,
+                properties, profile, {hashFn : text}, priority))
+            self._dispatch()
+        return True
+
+    def encode(self, encoderCls, format, hashFn, callback, profile=None):
+        '''
+        Encodes a WAV file already in the cache folder unless the encoding is
+        already being produced for another request. Encoding is always
+        interactive.
+
+        :param encoderCls: IEncoder implementation to use for encoding
+        :type encoderCls: class
+        :param format: Encoder format extension with the prefix `.`,
+            including the profile name if any
+        :type format: str
+        :param hashFn: Root name of the WAV file
+        :type hashFn: str
+        :param callback: Invoked as callback(hashFn, description) like the
+            callbacks of synthesize
+        :type callback: callable
+        :param profile: Name of the encoder quality profile or None
+        :type profile: str
+        :return: True if callback will be invoked or False if the queue has
+            no room for the work
+        :rtype: bool
+        '''
+        name = hashFn + format
+        if self.wait(name, callback):
+            self._promote(name)
+            return True
+        if self.is_full(1):
+            self.rejected += 1
+            return False
+        if not self.claim(name):
+            # wait until eviction has removed the old files from disk
+            self._index.after_eviction(name, functools.partial(self._retry,
+                self.encode, [hashFn], callback, encoderCls, format, hashFn,
+                callback, profile))
+            return True
+        self.wait(name, callback)
+        self._enqueue(SynthJob('encode', None, encoderCls, format, None,
+            profile, {hashFn : None}))
+        self._dispatch()
+        return True
+
+    def cancel(self, name, callback):
+        '''
+        Stops waiting on a cache file for a callback passed to synthesize, 
+        encode, or wait. Drops the job producing the file if it has not 
+        started and no other callbacks wait on the file. Kills a running job,
+        as a pipeline or in a worker process, once no callbacks wait on any
+        of its files.
+
+        :param name: Cache filename
+        :type name: str
+        :param callback: Callback waiting on the file
+        :type callback: callable
+        '''
+        waiters = self._flights.get(name)
+        if waiters is None or callback not in waiters:
+            return
+        waiters.remove(callback)
+        job = self._jobs.get(name)
+        if waiters or job is None:
+            return
+        if job.started is None:
+            hashFn = name[:-len(job.format)]
+            del job.texts[hashFn]
+            del self._jobs[name]
+            if not job.texts:
+                self._queues[job.priority].remove(job)
+                self._close_batch(job)
+                self.cancelled += 1
+            self.release(name, hashFn, CANCELLED)
+        elif job.task is not None:
+            for hashFn in job.texts:
+                if self._flights.get(hashFn + job.format):
+                    return
+            self.cancelled += 1
+            job.task.kill()
+
+    def claim(self, name):
+        '''
+        Marks a cache file as being produced outside the scheduler so that
+        later requests for it wait on the caller instead of synthesizing it
+        again. The caller must invoke release when the file is done.
+
+        :param name: Cache filename
+        :type name: str
+        :return: True if the caller should produce the file or False if it is
+            already in flight or being evicted
+        :rtype: bool
+        '''
+        if name in self._flights or self._index.is_evicting(name):
+            return False
+        self._flights[name] = []
+        self._index.pin(name)
+        return True
+
+    def wait(self, name, callback):
+        '''
+        Waits on a cache file that is in flight without starting any work.
+
+        :param name: Cache filename
+        :type name: str
+        :param callback: Invoked as callback(hashFn, description) like the
+            callbacks of synthesize when the file is done
+        :type callback: callable
+        :return: True if the file is in flight and callback will be invoked
+            or False if it is not in flight
+        :rtype: bool
+        '''
+        waiters = self._flights.get(name)
+        if waiters is None:
+            return False
+        waiters.append(callback)
+        return True
+
+    def release(self, name, hashFn, description):
+        '''
+        Ends the flight of a cache file claimed with claim and notifies all
+        callbacks waiting on it.
+
+        :param name: Cache filename
+        :type name: str
+        :param hashFn: Root name of the cache file
+        :type hashFn: str
+        :param description: None if the file is in place or a
+            developer-readable explanation of why synthesis failed
+        :type description: str
+        '''
+        if description is None:
+            self._index.add(name)
+        self._index.unpin(name)
+        for callback in self._flights.pop(name, []):
+            # a failing waiter must not keep the others waiting forever
+            try:
+                callback(hashFn, description)
+            except Exception:
+                logging.exception('Callback waiting on %s failed', name)
+
+    def is_full(self, count=1):
+        '''
+        :param count: Number of jobs about to be queued
+        :type count: int
+        :return: True if the queue has no room for count more jobs
+        :rtype: bool
+        '''
+        return bool(count and self.maxDepth and
+            self.get_depth() + count > self.maxDepth)
+
+    def get_depth(self, priority=None):
+        '''
+        :param priority: Priority class to count or None to count all jobs
+        :type priority: str
+        :return: Number of jobs waiting for a slot
+        :rtype: int
+        '''
+        if priority is not None:
+            return len(self._queues[priority])
+        return sum(len(queue) for queue in self._queues.values())
+
+    def estimate_wait(self, priority=PREFETCH):
+        '''
+        Estimates how long a job queued now waits before it runs. Interactive
+        jobs only wait on other interactive jobs while prefetch jobs may wait
+        on all of them.
+
+        :param priority: Priority class of the job
+        :type priority: str
+        :return: Seconds
+        :rtype: float
+        '''
+        if priority == INTERACTIVE:
+            depth = self.get_depth(INTERACTIVE)
+        else:
+            depth = self.get_depth()
+        return self._serviceTime * depth / self._slots
+
+    def get_retry_after(self):
+        '''
+        :return: Whole seconds a client refused for lack of room should wait
+            before trying again
+        :rtype: int
+        '''
+        return max(1, int(math.ceil(self.estimate_wait())))
+
+    def get_in_flight(self):
+        '''
+        :return: Number of cache files currently being synthesized
+        :rtype: int
+        '''
+        return len(self._flights)
+
+    def get_queue_stats(self):
+        '''
+        :return: Counters describing the queue
+        :rtype: dict
+        '''
+        return {
+            'depth' : self.get_depth(),
+            'interactive' : self.get_depth(INTERACTIVE),
+            'prefetch' : self.get_depth(PREFETCH),
+            'max_depth' : self.maxDepth,
+            'running' : self._running,
+            'slots' : self._slots,
+            'rejected' : self.rejected,
+            'cancelled' : self.cancelled,
+            'service_time' : self._serviceTime,
+            'wait_estimate' : self.estimate_wait(),
+            'interactive_wait_estimate' : self.estimate_wait(INTERACTIVE)
+        }
+
+    def _retry(self, method, hashFns, callback, *args):
+        # queue deferred work, failing its callbacks if there is no room
+        if not method(*args):
+            for hashFn in hashFns:
+                callback(hashFn, BUSY)
+
+    def _enqueue(self, job):
+        if job.kind == 'synth' and self.batchSize > 1:
+            hashFn, text = job.texts.items()[0]
+            key = (self._get_affinity(job), job.format, job.priority)
+            batch = self._batches.get(key)
+            if batch is not None:
+                batch.texts[hashFn] = text
+                self._jobs[hashFn + job.format] = batch
+                if len(batch.texts) >= self.batchSize:
+                    self._close_batch(batch)
+                return
+            job.batchKey = key
+            self._batches[key] = job
+        for hashFn in job.texts:
+            self._jobs[hashFn + job.format] = job
+        self._queues[job.priority].append(job)
+
+    def _get_affinity(self, job):
+        # engine and properties are part of the hash after the dash
+        if job.kind != 'synth':
+            return None
+        return job.texts.keys()[0].split('-')[1]
+
+    def _pick(self, queue):
+        # prefer a job whose voice is loaded on an idle worker
+        if self._executor is None:
+            for i in xrange(min(len(queue), self.LOOKAHEAD)):
+                job = queue[i]
+                key = self._get_affinity(job)
+                if key is not None and self._pool.is_warm(key):
+                    return job
+        return queue[0]
+
+    def _close_batch(self, job):
+        # stop collecting texts for a job
+        if job.batchKey is not None:
+            del self._batches[job.batchKey]
+            job.batchKey = None
+
+    def _promote(self, name):
+        # move a queued prefetch job behind the waiting interactive ones
+        job = self._jobs.get(name)
+        if job is None or job.started is not None or \
+        job.priority == INTERACTIVE:
+            return
+        self._queues[job.priority].remove(job)
+        self._close_batch(job)
+        job.priority = INTERACTIVE
+        self._queues[INTERACTIVE].append(job)
+
+    def _next_queue(self):
+        interactive = self._queues[INTERACTIVE]
+        prefetch = self._queues[PREFETCH]
+        if prefetch and (not interactive or 
+        time.time() - prefetch[0].enqueued >= self.AGING):
+            return prefetch
+        return interactive
+
+    def _dispatch(self):
+        while self.get_depth() and self._running < self._slots:
+            queue = self._next_queue()
+            job = self._pick(queue)
+            if job.batchKey is not None and self.batchWindow:
+                ready = job.enqueued + self.batchWindow
+                if ready > time.time():
+                    # let the batch fill until its window closes
+                    if self._timeout is None:
+                        self._timeout = tornado.ioloop.IOLoop.instance() \
+                            .add_timeout(ready, self._on_timeout)
+                    return
+            queue.remove(job)
+            self._close_batch(job)
+            self._running += 1
+            job.started = time.time()
+            self._run(job)
+
+    def _on_timeout(self):
+        self._timeout = None
+        self._dispatch()
+
+    def _run(self, job):
+        done = functools.partial(self._on_done, job)
+        if self._executor is not None:
+            hashFn, text = job.texts.items()[0]
+            if job.kind == 'encode':
+                task = self._executor.encode(job.encoderCls, job.format,
+                    hashFn, job.profile, done)
+            else:
+                task = self._executor.synthesize(job.engineCls,
+                    job.encoderCls, job.format, job.properties, hashFn, text,
+                    job.profile, done)
+            if task is not None:
+                # false if the job failed and is done already
+                job.task = task or None
+                return
+        if job.kind == 'encode':
+            func = self._encodeFunc
+            params = (job.encoderCls, job.texts.keys()[0], job.profile)
+        else:
+            func = self._func
+            # workers look the engine class up by the name of its module
+            params = (job.engineCls.__module__, job.encoderCls, job.texts,
+                job.properties, job.profile)
+        job.task = self._pool.apply_async(func, params, functools.partial(
+            self._on_response, job), self._get_affinity(job))
+
+    def _on_response(self, job, response):
+        if response is None:
+            response = {'description' : 'synthesis worker failed'}
+        # utterances of a batch fail separately
+        errors = response.get('errors', {})
+        result = response.get('result', {})
+        descriptions = {}
+        for hashFn in job.texts:
+            if hashFn in errors:
+                descriptions[hashFn] = errors[hashFn]
+            elif hashFn not in result:
+                descriptions[hashFn] = response.get('description')
+        self._on_done(job, response.get('description'), descriptions,
+            response.get('wav', False))
+
+    def _on_done(self, job, description, descriptions=None, wav=False):
+        self._running -= 1
+        if description != CANCELLED:
+            elapsed = time.time() - job.started
+            self._serviceTime += self.SERVICE_WEIGHT * (elapsed -
+                self._serviceTime)
+        for hashFn in job.texts:
+            if descriptions is not None:
+                description = descriptions.get(hashFn)
+            del self._jobs[hashFn + job.format]
+            if description is None and wav:
+                # index the WAV kept next to the encoding too so that
+                # eviction removes it
+                self._index.add(hashFn + '.wav')
+            self.release(hashFn + job.format, hashFn, description)
+        self._dispatch()
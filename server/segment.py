@@ -0,0 +1,224 @@
+'''
+Splits long utterances into segments that are synthesized and cached
+separately and joins the encoded segments back into one file on request.
+
+:requires: Python 2.6, Tornado 1.1
+:copyright: Peter Parente 2010
+:license: BSD
+'''
+import cache
+import tornado.ioloop
+import functools
+import hashlib
+import shutil
+import os
+import re
+
+# boundaries after sentence and clause punctuation
+SENTENCE_RX = re.compile(r'(?<=[.!?])\s+', re.UNICODE)
+CLAUSE_RX = re.compile(r'(?<=[,;:])\s+', re.UNICODE)
+# longest segment in characters before a sentence is split at its clauses
+MAX_SEGMENT_LENGTH = 200
+
+def split_utterance(utterance, maxLength=MAX_SEGMENT_LENGTH):
+    '''
+    Splits an utterance into segments at sentence boundaries. Splits
+    sentences longer than maxLength at clause boundaries too, keeping
+    consecutive clauses together up to maxLength.
+
+    :param utterance: Unicode text to split
+    :type utterance: unicode
+    :param maxLength: Longest sentence kept as one segment
+    :type maxLength: int
+    :return: Non-empty unicode segments in order, empty if the utterance is
+        blank
+    :rtype: list
+    '''
+    segments = []
+    for sentence in SENTENCE_RX.split(utterance.strip()):
+        if len(sentence) <= maxLength:
+            segments.append(sentence)
+            continue
+        current = u''
+        for clause in CLAUSE_RX.split(sentence):
+            if current and len(current) + len(clause) + 1 > maxLength:
+                segments.append(current)
+                current = clause
+            elif current:
+                current += u' ' + clause
+            else:
+                current = clause
+        segments.append(current)
+    return [segment for segment in segments if segment]
+
+def get_joined_hash(hashFns):
+    '''
+    Computes the root name of the file joining segments in the same format as
+    ISynthesizer.get_hash. The part after the dash is hashed again with a 
+    suffix so that no utterance text, such as the segment hashes themselves,
+    can name the joined file.
+
+    :param hashFns: Root names of the segments in order
+    :type hashFns: list
+    :return: Root name of the joined file
+    :rtype: str
+    '''
+    utterHashes = [hashFn.split('-')[0] for hashFn in hashFns]
+    optHash = hashFns[0].split('-')[1]
+    return '%s-%s' % (hashlib.sha1(' '.join(utterHashes)).hexdigest(),
+        hashlib.sha1(optHash + 'join').hexdigest())
+
+def join_files(path, sources, name):
+    '''
+    Concatenates encoded segments into a file in the cache folder. Meant to
+    run in the I/O thread pool.
+
+    :param path: Path to where synthesized files are stored
+    :type path: str
+    :param sources: Segment filenames relative to the cache folder or open
+        file objects for segments stored elsewhere, in order
+    :type sources: list
+    :param name: Filename of the joined file relative to the cache folder
+    :type name: str
+    :return: None if the joined file is in place or a developer-readable
+        explanation of why joining failed
+    :rtype: str
+    '''
+    # packed segments not copied yet are closed however joining ends
+    pending = list(sources)
+    tmp = None
+    description = None
+    try:
+        try:
+            fn = cache.make_path(path, name)
+            tmp = cache.get_temp_path(fn)
+            out = open(tmp, 'wb')
+            try:
+                while pending:
+                    source = pending.pop(0)
+                    if isinstance(source, basestring):
+                        try:
+                            fh = open(cache.find_path(path, source) or source,
+                                'rb')
+                        except IOError:
+                            description = 'missing segment %s' % source
+                            break
+                    else:
+                        fh = source
+                    try:
+                        shutil.copyfileobj(fh, out)
+                    finally:
+                        fh.close()
+            finally:
+                out.close()
+            if description is None:
+                os.rename(tmp, fn)
+                return None
+        except Exception, e:
+            # the pool drops exceptions, always describe the failure
+            description = 'could not write %s' % e
+        if tmp is not None:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+        return description
+    finally:
+        for source in pending:
+            if not isinstance(source, basestring):
+                source.close()
+
+class SegmentJoiner(object):
+    '''
+    Joins encoded segments into single files in the cache folder in the I/O
+    thread pool. Joins of the same segments are coalesced with each other and
+    with synthesis in the SynthScheduler so a joined file is written at most
+    once at a time.
+
+    Encoded Ogg segments join into a chained Ogg stream and MP3 segments into
+    a sequence of MP3 frames.
+
+    All methods must be called on the IOLoop thread. Callbacks are always
+    invoked on the IOLoop thread.
+
+    :ivar _path: Cache folder path
+    :ivar _index: cache.CacheIndex of the folder
+    :ivar _scheduler: scheduler.SynthScheduler tracking files in flight
+    :ivar _ioPool: Thread pool for disk access
+    :ivar _packStore: pack.PackStore holding small segments or None
+    '''
+    def __init__(self, path, index, scheduler, ioPool, packStore=None):
+        '''
+        Constructor.
+
+        :param path: Path to where synthesized files are stored
+        :type path: str
+        :param index: Index of the cache folder
+        :type index: cache.CacheIndex
+        :param scheduler: Scheduler of synthesis work
+        :type scheduler: scheduler.SynthScheduler
+        :param ioPool: Thread pool for disk access
+        :type ioPool: multiprocessing.pool.ThreadPool
+        :param packStore: Store that may hold segments or None
+        :type packStore: pack.PackStore
+        '''
+        self._path = path
+        self._index = index
+        self._scheduler = scheduler
+        self._ioPool = ioPool
+        self._packStore = packStore
+
+    def join(self, hashFns, format, callback):
+        '''
+        Joins encoded segments already in the cache into one file unless the
+        file exists.
+
+        :param hashFns: Root names of the segments in order
+        :type hashFns: list
+        :param format: Encoder format extension with the prefix `.`
+        :type format: str
+        :param callback: Invoked as callback(hashFn, description) where hashFn
+            is the root name of the joined file and description is None on
+            success or a developer-readable explanation of the failure
+        :type callback: callable
+        '''
+        joinFn = get_joined_hash(hashFns)
+        name = joinFn + format
+        if name in self._index:
+            self._index.touch(name)
+            callback(joinFn, None)
+            return
+        if self._scheduler.wait(name, callback):
+            return
+        if not self._scheduler.claim(name):
+            # wait until eviction has removed the old file from disk
+            self._index.after_eviction(name, functools.partial(self.join,
+                hashFns, format, callback))
+            return
+        self._scheduler.wait(name, callback)
+        names = [hashFn + format for hashFn in hashFns]
+        for segment in names:
+            self._index.pin(segment)
+        self._start(joinFn, name, names, False)
+
+    def _start(self, joinFn, name, names, retried):
+        sources = []
+        for segment in names:
+            packed = self._packStore is not None and \
+                self._packStore.open(segment)
+            sources.append(packed and packed[0] or segment)
+        loop = tornado.ioloop.IOLoop.instance()
+        cb = functools.partial(self._on_joined, joinFn, name, names, retried)
+        self._ioPool.apply_async(join_files, (self._path, sources, name),
+            callback=lambda result: loop.add_callback(
+                functools.partial(cb, result)))
+
+    def _on_joined(self, joinFn, name, names, retried, description):
+        if description is not None and not retried and \
+        self._packStore is not None:
+            # segments may have moved into the pack store while joining
+            self._start(joinFn, name, names, True)
+            return
+        for segment in names:
+            self._index.unpin(segment)
+        self._scheduler.release(name, joinFn, description)
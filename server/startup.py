@@ -0,0 +1,146 @@
+'''
+Background discovery of the speech engines and indexing of the cache folder
+so that the HTTP socket of the JSonic server serves cached files right away.
+
+:requires: Python 2.6, Tornado 1.1
+:copyright: Peter Parente 2010
+:license: BSD
+'''
+import synthesizer
+import cache
+import tornado.ioloop
+import threading
+import functools
+import logging
+import time
+
+class Startup(object):
+    '''
+    Probes the speech engines and builds the engine catalog in a thread
+    while the server answers requests that do not need the engines. Walks
+    the cache folder in another thread to load the cache index. Records how
+    long each phase of startup takes for the startup report.
+
+    Methods other than mark must be called on the IOLoop thread. Callbacks
+    are always invoked on the IOLoop thread.
+
+    :ivar ready: True once the engines are available
+    :ivar indexed: True once the cache index is loaded
+    :ivar _catalog: catalog.EngineCatalog to fill
+    :ivar _started: Time the process started startup
+    :ivar _last: Time the previous phase ended
+    :ivar _phases: Tuples of (phase name, seconds) in order
+    :ivar _waiting: Callbacks waiting for ready
+    '''
+    def __init__(self, catalog):
+        '''
+        Constructor.
+
+        :param catalog: Engine catalog to fill once the engines are probed
+        :type catalog: catalog.EngineCatalog
+        '''
+        self.ready = False
+        self.indexed = False
+        self._catalog = catalog
+        self._started = self._last = time.time()
+        self._phases = []
+        self._waiting = []
+
+    def mark(self, phase):
+        '''
+        Ends a phase of startup that began when the previous one ended.
+
+        :param phase: Name of the phase
+        :type phase: str
+        '''
+        now = time.time()
+        self._phases.append((phase, now - self._last))
+        self._last = now
+
+    def start(self, index, path, pids):
+        '''
+        Starts probing engines and loading the cache index in the background.
+        The worker processes must be forked before this starts the first
+        thread.
+
+        :param index: Empty index of the cache folder to load
+        :type index: cache.CacheIndex
+        :param path: Path to where synthesized files are stored
+        :type path: str
+        :param pids: IDs of the processes that may be writing files into the
+            cache folder already
+        :type pids: list
+        '''
+        for target, args in ((self._probe_thread, ()), 
+        (self._index_thread, (index, path, pids))):
+            thread = threading.Thread(target=target, args=args)
+            thread.setDaemon(True)
+            thread.start()
+
+    def when_ready(self, callback):
+        '''
+        Invokes a callback once the engines are available.
+
+        :param callback: Invoked with no arguments
+        :type callback: callable
+        '''
+        if self.ready:
+            callback()
+        else:
+            self._waiting.append(callback)
+
+    def get_stats(self):
+        '''
+        :return: Seconds taken by each phase of startup so far and in total
+            and whether startup is done
+        :rtype: dict
+        '''
+        return {
+            'ready' : self.ready,
+            'indexed' : self.indexed,
+            'phases' : [{'name' : name, 'seconds' : seconds}
+                for name, seconds in self._phases],
+            'seconds' : self._last - self._started
+        }
+
+    def _probe_thread(self):
+        loop = tornado.ioloop.IOLoop.instance()
+        try:
+            synthesizer.init(self._catalog.get_fingerprints())
+            self.mark('engines')
+            missing = self._catalog.load(synthesizer.AVAILABLE_SYNTHS)
+            if missing:
+                self._catalog.build(missing)
+            self.mark('catalog')
+        except Exception:
+            logging.exception('Could not start the speech engines')
+            loop.add_callback(loop.stop)
+            return
+        loop.add_callback(self._on_probed)
+
+    def _index_thread(self, index, path, pids):
+        started = time.time()
+        loop = tornado.ioloop.IOLoop.instance()
+        try:
+            scanned = cache.scan_folder(path, pids)
+        except Exception:
+            logging.exception('Could not index the cache folder')
+            loop.add_callback(loop.stop)
+            return
+        loop.add_callback(functools.partial(self._on_indexed, index, 
+            scanned, time.time() - started))
+
+    def _on_indexed(self, index, scanned, seconds):
+        index.update(scanned)
+        self.indexed = True
+        # runs alongside the other phases rather than after them
+        self._phases.append(('index', seconds))
+        logging.info('Indexed %d cache files in %.3fs', len(index), seconds)
+
+    def _on_probed(self):
+        self.ready = True
+        logging.info('Started in %.3fs (%s)', self._last - self._started,
+            ', '.join('%s %.3fs' % phase for phase in self._phases))
+        waiting, self._waiting = self._waiting, []
+        for callback in waiting:
+            callback()
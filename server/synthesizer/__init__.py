@@ -17,6 +17,7 @@ import linecache
 import logging
 import os.path
 import sys
+import threading
 
 class SynthesizerError(Exception): 
     '''
@@ -28,7 +29,12 @@ class SynthesizerError(Exception):
 class ISynthesizer(object):
     '''
     All synthesizers must implement this instance and class interface.
+
+    :cvar VOICES: Set of the voice names listed by get_info cached by
+        get_voices
     '''
+    VOICES = None
+
     def __init__(self, path, properties):
         '''
         Constructor.
@@ -40,9 +46,40 @@ class ISynthesizer(object):
             dictated by the synthesizer implementation as returned by the
             get_info class method.
         :param properties: dict 
+        :raises: SynthesizerError if the properties are invalid
+        '''
+        raise NotImplementedError
+
+    @classmethod
+    def get_options(cls, properties):
+        '''
+        Validates speech properties and converts them to the engine options 
+        an instance uses. Properties with equal options synthesize the same
+        speech, so the options identify instances that can be shared.
+
+        :param properties: Speech properties as passed to the constructor
+        :type properties: dict
+        :return: Engine options
+        :rtype: tuple
+        :raises: SynthesizerError if the properties are invalid
         '''
         raise NotImplementedError
     
+    def get_hash(self, utterance):
+        '''
+        Computes the root name of the file that write_wav would produce for an
+        utterance without synthesizing it. The name must be in the following 
+        format:
+
+        <sha1 hash of utterance>-<sha1 hash of engine + synth properties>
+        
+        :param utterance: Unicode text to synthesize as speech
+        :type utterance: unicode
+        :return: Root name of the WAV file on disk, sans extension
+        :rtype: str
+        '''
+        raise NotImplementedError
+
     def write_wav(self, utterance):
         '''
         Synthesizes an utterance to a WAV file on disk in the cache folder. 
@@ -56,6 +93,32 @@ class ISynthesizer(object):
         :rtype: str
         '''
         raise NotImplementedError
+
+    def stream_wav(self, utterance, out):
+        '''
+        Synthesizes an utterance as WAV data written to a file object instead
+        of a file in the cache folder. Used to pipe speech straight into an 
+        encoder.
+        
+        :param utterance: Unicode text to synthesize as speech
+        :type utterance: unicode
+        :param out: Writable file object, typically the stdin pipe of an 
+            encoder process
+        :type out: file
+        '''
+        raise NotImplementedError
+
+    def get_wav_command(self):
+        '''
+        Gets a command line that reads an utterance as UTF-8 text from stdin
+        and writes the synthesized speech as WAV data to stdout. Used to run
+        the engine as a child of the server process without blocking it.
+        
+        :return: Command line arguments or None if the engine cannot run as a
+            separate command
+        :rtype: list
+        '''
+        raise NotImplementedError
     
     @classmethod
     def get_info(cls):
@@ -92,6 +155,32 @@ class ISynthesizer(object):
         '''
         raise NotImplementedError
 
+    @classmethod
+    def get_fingerprint(cls):
+        '''
+        Gets a description of the installed engine that changes whenever the
+        result of get_info may change, such as the version or modification 
+        time of the engine, so that the info can be persisted between runs.
+        Must be cheap compared to get_info.
+
+        :return: Fingerprint or None if the info must be queried on every run
+        :rtype: str
+        '''
+        return None
+
+    @classmethod
+    def get_voices(cls):
+        '''
+        Gets the voice names listed by get_info as a set for constant time
+        validation of voice properties.
+
+        :return: Voice names
+        :rtype: frozenset
+        '''
+        if cls.VOICES is None:
+            cls.VOICES = frozenset(cls.get_info()['voices']['values'])
+        return cls.VOICES
+
 # A dictionary containing the names of modules containing synth implementations
 # provided by JSonic, mapped to a boolean value indicating whether support for
 # this module is required.  For example, the espeak module is used as a default
@@ -104,6 +193,9 @@ IMPLEMENTED_SYNTHS = { 'espeak': True, 'macosx': False }
 # assumed to function properly; prerequisites can be checked in the main body
 # of a module (outside classes and functions) and exceptions raised to prevent
 # synthesizers from being added to SYNTHS on platforms where they do not work.
+# Slow checks, such as running the engine, belong in a module level probe()
+# function instead so that they run in parallel and are skipped when the 
+# engine fingerprint matches one that passed before.
 AVAILABLE_SYNTHS = {}
 
 # Look for synth modules in these directories.
@@ -112,26 +204,57 @@ synth_path = [os.path.dirname(__file__)]
 # init() would ordinarily be module-level code, but since it performs logging
 # of successful and unsuccessful module imports, it must be called after the
 # run() method in jsonic.py has initialized the logging module.
-def init():
+def init(known=None):
     '''
-    Populates JSonic's dictionary of available synthesizer classes.
+    Populates JSonic's dictionary of available synthesizer classes. Loads and
+    probes the synth modules in parallel.
+    
+    :param known: Names of synth modules paired with the fingerprints of the
+        engines the last time they probed successfully, or None to probe all
+        engines
+    :type known: dict
     '''
+    known = known or {}
+    results = {}
+    threads = [threading.Thread(target=_load, args=(synth, known, results)) 
+        for synth in IMPLEMENTED_SYNTHS]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
     for synth in IMPLEMENTED_SYNTHS:
-        module_info = imp.find_module(synth, synth_path)
-        try:
-            module = imp.load_module(synth, *module_info)
-            synth_class = module.SynthClass
-        except:
+        result = results[synth]
+        if isinstance(result, tuple):
             sys.modules.pop(synth, None)
-            logging.info('Could not import synth module "%s"', synth, exc_info=True)
+            logging.info('Could not import synth module "%s"', synth, exc_info=result)
             if IMPLEMENTED_SYNTHS[synth]:
                 raise SynthesizerError('Required synth module "%s" is unavailable' % synth)
         else:
-            AVAILABLE_SYNTHS[synth] = synth_class
+            AVAILABLE_SYNTHS[synth] = result
             logging.info('Successfully imported synth module "%s"', synth)
         
     linecache.checkcache()
 
+def _load(synth, known, results):
+    # imports serialize on the import lock, but probes run in parallel
+    try:
+        module_info = imp.find_module(synth, synth_path)
+        try:
+            module = imp.load_module(synth, *module_info)
+        finally:
+            if module_info[0] is not None:
+                module_info[0].close()
+        synth_class = module.SynthClass
+        fingerprint = synth_class.get_fingerprint()
+        probe = getattr(module, 'probe', None)
+        if probe is not None and (fingerprint is None or 
+        known.get(synth) != fingerprint):
+            probe()
+    except:
+        results[synth] = sys.exc_info()
+    else:
+        results[synth] = synth_class
+
 def get_class(name):
     '''
     Gets the synthesizer class associated with the given synth engine name.
@@ -1,5 +1,7 @@
 '''
-espeak speech synthesizer implementation for JSonic.
+espeak speech synthesizer implementation for JSonic. Synthesizes in-process
+using libespeak when the shared library is available and falls back on the
+`speak` command otherwise.
 
 :requires: Python 2.6, iterpipes 0.3, espeak 1.36.02
 :copyright: Peter Parente 2010
@@ -8,9 +10,15 @@ espeak speech synthesizer implementation for JSonic.
 from synthesizer import *
 
 import iterpipes
+import cache
+import ctypes
+import ctypes.util
 import hashlib
 import itertools
 import os.path
+import StringIO
+import subprocess
+import wave
 
 class EspeakSynth(ISynthesizer):
     '''
@@ -36,52 +44,97 @@ class EspeakSynth(ISynthesizer):
         '''Implements ISynthesizer constructor.'''
         # path where to write the file
         self._path = path
-        # construct command line options for this synth instance
-        self._opts = []
+        # command line options for this synth instance
+        self._opts = list(self.get_options(properties))
+        # store property portion of filename
+        self._optHash = hashlib.sha1('espeak' + str(self._opts)).hexdigest()
+
+    @classmethod
+    def get_options(cls, properties):
+        '''Implements ISynthesizer.get_options.'''
+        opts = []
         try:
             rate = int(properties['rate'])
-            rate = min(max(rate, self.MIN_RATE), self.MAX_RATE)
-            self._opts.append(str(rate))
+            rate = min(max(rate, cls.MIN_RATE), cls.MAX_RATE)
+            opts.append(str(rate))
         except TypeError:
             raise SynthesizerError('invalid rate')
         except KeyError:
-            self._opts.append('200')
+            opts.append('200')
 
         try:
             pitch = int(properties['pitch'] * 100)
-            pitch = min(max(pitch, self.MIN_PITCH), self.MAX_PITCH)
-            self._opts.append(str(pitch))
+            pitch = min(max(pitch, cls.MIN_PITCH), cls.MAX_PITCH)
+            opts.append(str(pitch))
         except TypeError:
             raise SynthesizerError('invalid pitch')
         except KeyError:
-            self._opts.append('50')
+            opts.append('50')
 
         try:
             voice = str(properties['voice'])
-            assert voice in EspeakSynth.get_info()['voices']['values']
-            self._opts.append(voice)
+            assert voice in cls.get_voices()
+            opts.append(voice)
         except AssertionError:
             raise SynthesizerError('invalid voice')
         except KeyError:
-            self._opts.append('default')
+            opts.append('default')
+        return tuple(opts)
 
-        # store property portion of filename
-        self._optHash = hashlib.sha1('espeak' + str(self._opts)).hexdigest()
+    def get_hash(self, utterance):
+        '''Implements ISynthesizer.get_hash.'''
+        utf8Utterance = utterance.encode('utf-8')
+        utterHash = hashlib.sha1(utf8Utterance).hexdigest()
+        return '%s-%s' % (utterHash, self._optHash)
 
     def write_wav(self, utterance):
         '''Implements ISynthesizer.write_wav.'''
-        utf8Utterance = utterance.encode('utf-8')
-        utterHash = hashlib.sha1(utf8Utterance).hexdigest()
-        hashFn = '%s-%s' % (utterHash, self._optHash)
+        hashFn = self.get_hash(utterance)
         # write wave file into path
-        wav = os.path.join(self._path, hashFn+'.wav')
+        wav = cache.make_path(self._path, hashFn+'.wav')
         if not os.path.isfile(wav):
-            args = self._opts + [wav]
+            # write under a temporary name so other readers never see a 
+            # partial file
+            tmp = cache.get_temp_path(wav)
+            args = self._opts + [tmp]
             c = iterpipes.cmd('speak -s{} -p{} -v{} -w{}', *args, 
                 encoding='utf-8')
             ret = iterpipes.call(c, utterance)
+            if ret != 0 or not os.path.isfile(tmp):
+                try:
+                    os.remove(tmp)
+                except OSError:
+                    pass
+                raise SynthesizerError('speak failed with exit code %s' % ret)
+            os.rename(tmp, wav)
         return hashFn
 
+    def stream_wav(self, utterance, out):
+        '''Implements ISynthesizer.stream_wav.'''
+        # let speak write directly into the output pipe
+        p = subprocess.Popen(self.get_wav_command(), stdin=subprocess.PIPE,
+            stdout=out)
+        p.communicate(utterance.encode('utf-8'))
+        if p.returncode != 0:
+            raise SynthesizerError('speak failed with exit code %s' % 
+                p.returncode)
+
+    def get_wav_command(self):
+        '''Implements ISynthesizer.get_wav_command.'''
+        rate, pitch, voice = self._opts
+        return ['speak', '-s'+rate, '-p'+pitch, '-v'+voice, '--stdout']
+
+    @classmethod
+    def get_fingerprint(cls):
+        '''Implements ISynthesizer.get_fingerprint.'''
+        # voices ship with the speak binary so a new install replaces it
+        for folder in os.environ.get('PATH', '').split(os.pathsep):
+            fn = os.path.join(folder, 'speak')
+            if os.path.isfile(fn):
+                st = os.stat(fn)
+                return 'speak %s %d %d' % (fn, st.st_size, int(st.st_mtime))
+        return None
+
     @classmethod
     def get_info(cls):
         '''Implements ISynthesizer.get_info.'''
@@ -114,7 +167,177 @@ class EspeakSynth(ISynthesizer):
             }
         return cls.INFO
 
-SynthClass = EspeakSynth
+# constants from speak_lib.h
+AUDIO_OUTPUT_SYNCHRONOUS = 2
+POS_CHARACTER = 1
+ESPEAK_CHARS_UTF8 = 1
+ESPEAK_RATE = 1
+ESPEAK_PITCH = 3
+EE_OK = 0
+SYNTH_CALLBACK = ctypes.CFUNCTYPE(ctypes.c_int, 
+    ctypes.POINTER(ctypes.c_short), ctypes.c_int, ctypes.c_void_p)
+
+class LibEspeak(object):
+    '''
+    Wraps an initialized instance of libespeak producing 16-bit mono PCM. 
+    libespeak holds global state so there must be at most one instance per 
+    process, obtained with get_instance.
+    
+    :ivar _lib: ctypes handle to libespeak
+    :ivar _callback: Synth callback kept alive for the lifetime of the engine
+    :ivar _params: Rate, pitch and voice currently set on the engine
+    :ivar _chunks: PCM chunks collected for the utterance in progress
+    :ivar sampleRate: Sample rate of the produced PCM in Hz
+    :cvar INSTANCE: Singleton instance for this process
+    '''
+    INSTANCE = None
 
-# Make sure that espeak is installed and functioning by asking for voices.
-iterpipes.check_call(iterpipes.linecmd('speak --voices'))
\ No newline at end of file
+    def __init__(self, lib):
+        '''
+        Constructor. Loads the engine and its data.
+        
+        :param lib: ctypes handle to libespeak
+        :type lib: ctypes.CDLL
+        :raises: SynthesizerError
+        '''
+        self._lib = lib
+        self.sampleRate = lib.espeak_Initialize(AUDIO_OUTPUT_SYNCHRONOUS, 0, 
+            None, 0)
+        if self.sampleRate <= 0:
+            raise SynthesizerError('libespeak failed to initialize')
+        self._callback = SYNTH_CALLBACK(self._on_samples)
+        lib.espeak_SetSynthCallback(self._callback)
+        self._params = [None, None, None]
+        self._chunks = None
+
+    @classmethod
+    def get_instance(cls):
+        '''
+        Gets the engine for this process, initializing it on first use.
+        
+        :return: Engine instance
+        :rtype: LibEspeak
+        :raises: SynthesizerError
+        '''
+        if cls.INSTANCE is None:
+            cls.INSTANCE = cls(LIBESPEAK)
+        return cls.INSTANCE
+
+    def _on_samples(self, wav, numsamples, events):
+        if wav and numsamples > 0:
+            self._chunks.append(ctypes.string_at(wav, numsamples * 2))
+        return 0
+
+    def _set_params(self, rate, pitch, voice):
+        # only touch the engine when a parameter changes so that the voice
+        # data is loaded once per worker per voice
+        if voice != self._params[2]:
+            if self._lib.espeak_SetVoiceByName(voice) != EE_OK:
+                self._params[2] = None
+                raise SynthesizerError('invalid voice')
+            # loading a voice resets the other parameters
+            self._params = [None, None, voice]
+        if rate != self._params[0]:
+            self._lib.espeak_SetParameter(ESPEAK_RATE, rate, 0)
+            self._params[0] = rate
+        if pitch != self._params[1]:
+            self._lib.espeak_SetParameter(ESPEAK_PITCH, pitch, 0)
+            self._params[1] = pitch
+
+    def synth(self, utterance, rate, pitch, voice):
+        '''
+        Synthesizes an utterance to raw PCM.
+        
+        :param utterance: Unicode text to synthesize as speech
+        :type utterance: unicode
+        :param rate: Rate in WPM
+        :type rate: int
+        :param pitch: Pitch in the range [0, 99]
+        :type pitch: int
+        :param voice: espeak voice name with optional variant
+        :type voice: str
+        :return: 16-bit mono PCM at sampleRate
+        :rtype: str
+        :raises: SynthesizerError
+        '''
+        self._set_params(rate, pitch, voice)
+        text = utterance.encode('utf-8')
+        self._chunks = []
+        try:
+            err = self._lib.espeak_Synth(text, len(text)+1, 0, POS_CHARACTER,
+                0, ESPEAK_CHARS_UTF8, None, None)
+            if err != EE_OK:
+                raise SynthesizerError('libespeak failed with error %d' % err)
+            return ''.join(self._chunks)
+        finally:
+            self._chunks = None
+
+class EspeakLibSynth(EspeakSynth):
+    '''
+    Synthesizes speech using libespeak loaded into the worker process. Keeps 
+    the engine and the most recently used voice loaded across utterances 
+    instead of starting `speak` for each one. Produces the same WAV files under
+    the same cache filenames as EspeakSynth.
+    '''
+    def write_wav(self, utterance):
+        '''Implements ISynthesizer.write_wav.'''
+        hashFn = self.get_hash(utterance)
+        # write wave file into path
+        wav = cache.make_path(self._path, hashFn+'.wav')
+        if not os.path.isfile(wav):
+            # write under a temporary name so other readers never see a 
+            # partial file
+            tmp = cache.get_temp_path(wav)
+            fh = open(tmp, 'wb')
+            try:
+                self._write_pcm(utterance, fh)
+            finally:
+                fh.close()
+            os.rename(tmp, wav)
+        return hashFn
+
+    def stream_wav(self, utterance, out):
+        '''Implements ISynthesizer.stream_wav.'''
+        # build the whole file in memory first because the wave module must
+        # seek back to fill in the header
+        buff = StringIO.StringIO()
+        self._write_pcm(utterance, buff)
+        out.write(buff.getvalue())
+
+    def _write_pcm(self, utterance, fh):
+        '''
+        Synthesizes an utterance and writes it as WAV to a seekable file 
+        object.
+        
+        :param utterance: Unicode text to synthesize as speech
+        :type utterance: unicode
+        :param fh: File object
+        :type fh: file
+        '''
+        engine = LibEspeak.get_instance()
+        rate, pitch, voice = self._opts
+        pcm = engine.synth(utterance, int(rate), int(pitch), voice)
+        out = wave.open(fh, 'wb')
+        out.setnchannels(1)
+        out.setsampwidth(2)
+        out.setframerate(engine.sampleRate)
+        out.writeframes(pcm)
+        out.close()
+
+# Use libespeak in-process if it is installed
+LIBESPEAK = None
+try:
+    LIBESPEAK = ctypes.CDLL(ctypes.util.find_library('espeak') or 
+        'libespeak.so.1')
+except OSError:
+    SynthClass = EspeakSynth
+else:
+    SynthClass = EspeakLibSynth
+
+def probe():
+    '''
+    Makes sure that espeak is installed and functioning by asking for voices.
+
+    :raises: Exception if `speak` is missing or fails
+    '''
+    iterpipes.check_call(iterpipes.linecmd('speak --voices'))
\ No newline at end of file
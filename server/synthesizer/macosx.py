@@ -11,12 +11,18 @@ import AppKit
 from PyObjCTools.AppHelper import installMachInterrupt
 import QTKit
 
+import cache
 import hashlib
 import os.path
+import platform
+import shutil
 import struct
 import subprocess
 import sys
 
+# folder holding the system voices
+VOICES_PATH = '/System/Library/Speech/Voices'
+
 class MacOSXSpeechSynth(ISynthesizer):
     '''
     Synthesizes speech using NSSpeechSynthesizer (Mac OS X 10.6 or later).
@@ -37,45 +43,100 @@ class MacOSXSpeechSynth(ISynthesizer):
         # path where to write the file
         self._path = path
         # NSSpeechSynthesizer options for this synth instance
-        self._opts = []
-        
+        self._opts = list(self.get_options(properties))
+        # store property portion of filename
+        self._optHash = hashlib.sha1('macosx' + str(self._opts)).hexdigest()
+
+    @classmethod
+    def get_options(cls, properties):
+        '''Implements ISynthesizer.get_options.'''
+        opts = []
         try:
             rate = int(properties['rate'])
-            rate = min(max(rate, self.MIN_RATE), self.MAX_RATE)
-            self._opts.append(str(rate))
+            rate = min(max(rate, cls.MIN_RATE), cls.MAX_RATE)
+            opts.append(str(rate))
         except TypeError:
             raise SynthesizerError('invalid rate')
         except KeyError:
-            self._opts.append('200')
+            opts.append('200')
         
         try:
             voice = str(properties['voice'])
-            assert voice in MacOSXSpeechSynth.get_info()['voices']['values']
-            self._opts.append(voice)
+            assert voice in cls.get_voices()
+            opts.append(voice)
         except AssertionError:
             raise SynthesizerError('invalid voice')
         except KeyError:
-            self._opts.append('default')
+            opts.append('default')
+        return tuple(opts)
 
-        # store property portion of filename
-        self._optHash = hashlib.sha1('macosx' + str(self._opts)).hexdigest()
+    def get_hash(self, utterance):
+        '''Implements ISynthesizer.get_hash.'''
+        utf8Utterance = utterance.encode('utf-8')
+        utterHash = hashlib.sha1(utf8Utterance).hexdigest()
+        return '%s-%s' % (utterHash, self._optHash)
 
     def write_wav(self, utterance):
         '''Implements ISynthesizer.write_wav.'''
-        utf8Utterance = utterance.encode('utf-8')
-        utterHash = hashlib.sha1(utf8Utterance).hexdigest()
-        hashFn = '%s-%s' % (utterHash, self._optHash)
+        hashFn = self.get_hash(utterance)
+        prefix = cache.make_path(self._path, hashFn)
+        if not os.path.isfile(prefix + '.wav'):
+            # synthesize under a temporary prefix so other readers never see
+            # a partial file
+            tmp = cache.get_temp_path(prefix)
+            self._synth_to(utterance, tmp)
+            os.rename(tmp + '.wav', prefix + '.wav')
+        return hashFn
+
+    def stream_wav(self, utterance, out):
+        '''Implements ISynthesizer.stream_wav.'''
+        # NSSpeechSynthesizer can only write to a file, so copy it out
+        tmp = cache.get_temp_path(cache.make_path(self._path, 
+            self.get_hash(utterance)))
+        self._synth_to(utterance, tmp)
+        try:
+            fh = open(tmp + '.wav', 'rb')
+            try:
+                shutil.copyfileobj(fh, out)
+            finally:
+                fh.close()
+        finally:
+            os.remove(tmp + '.wav')
+
+    def get_wav_command(self):
+        '''Implements ISynthesizer.get_wav_command.'''
+        # NSSpeechSynthesizer only runs in this process
+        return None
+
+    def _synth_to(self, utterance, prefix):
+        '''
+        Synthesizes an utterance to <prefix>.wav.
         
+        :param utterance: Unicode text to synthesize as speech
+        :type utterance: unicode
+        :param prefix: Path of the WAV file, sans extension
+        :type prefix: str
+        :raises: SynthesizerError
+        '''
         # Invoke the __main__ portion of this file on the command line, passing 
         # in the rate, voice, and output prefix name as arguments, and the text 
         # to utter on standard input.
-        prefix = os.path.join(self._path, hashFn)
-        if not os.path.isfile(prefix + '.wav'):
-            args = [sys.executable, __file__] + self._opts + [os.path.abspath(prefix)]
-            p = subprocess.Popen(args, stdin=subprocess.PIPE,
-                                 env={'PYTHONPATH': '.'})
-            p.communicate(utterance)
-        return hashFn
+        args = [sys.executable, __file__] + self._opts + [os.path.abspath(prefix)]
+        p = subprocess.Popen(args, stdin=subprocess.PIPE,
+                             env={'PYTHONPATH': '.'})
+        p.communicate(utterance)
+        if p.returncode != 0 or not os.path.isfile(prefix + '.wav'):
+            raise SynthesizerError('speech synthesis failed')
+
+    @classmethod
+    def get_fingerprint(cls):
+        '''Implements ISynthesizer.get_fingerprint.'''
+        # voices come with the system or are installed into its voice folder
+        try:
+            mtime = int(os.path.getmtime(VOICES_PATH))
+        except OSError:
+            mtime = 0
+        return 'macosx %s %d' % (platform.mac_ver()[0], mtime)
 
     @classmethod
     def get_info(cls):
@@ -0,0 +1,328 @@
+'''
+Worker processes for synthesis that keep jobs for the same engine and voice
+on the same process.
+
+:requires: Python 2.6, Tornado 1.1
+:copyright: Peter Parente 2010
+:license: BSD
+'''
+import tornado.ioloop
+import multiprocessing
+import collections
+import functools
+import itertools
+import logging
+import signal
+import time
+import os
+
+# signal the server sends a worker process to cancel a task
+CANCEL_SIGNAL = signal.SIGUSR1
+# signal a worker process sends its process group to terminate the commands
+# of a cancelled task, the worker itself handles it and lives on
+KILL_SIGNAL = signal.SIGHUP
+# number of the task running in this worker process or None
+_task = None
+# shared value the server stores the number of a cancelled task in
+_cancel = None
+
+def is_cancelled():
+    '''
+    Tells a function running in a worker process whether the server has 
+    cancelled its task so that it can skip the rest of its work.
+
+    :return: True if the task running in this process was cancelled
+    :rtype: bool
+    '''
+    return _task is not None and _cancel.value == _task
+
+def serve(conn, inherited, cancel):
+    '''
+    Runs the functions sent by a WorkerPool one after another in a worker
+    process and sends back their return values until the server goes away.
+
+    :param conn: Worker end of the connection to the server
+    :type conn: multiprocessing.Connection
+    :param inherited: Server ends of the connections to this and the
+        workers forked earlier, which only the server may hold for workers to
+        see it go away
+    :type inherited: list
+    :param cancel: Shared value holding the number of a cancelled task
+    :type cancel: multiprocessing.sharedctypes.RawValue
+    '''
+    global _task, _cancel
+    for other in inherited:
+        other.close()
+    _cancel = cancel
+    # lead a process group holding the commands tasks run so that they can
+    # be terminated together
+    os.setpgid(0, 0)
+    signal.signal(CANCEL_SIGNAL, _on_cancel_signal)
+    # a handler rather than ignoring the signal so that commands do not 
+    # inherit the disposition
+    signal.signal(KILL_SIGNAL, _on_kill_signal)
+    while True:
+        try:
+            _task, func, args = conn.recv()
+            result = func(*args)
+        except EOFError:
+            return
+        except Exception:
+            # answer anyway so the server is not left waiting
+            logging.exception('Worker task failed')
+            result = None
+        _task = None
+        conn.send(result)
+
+def _on_cancel_signal(signum, frame):
+    # runs between bytecodes of the task, so the task cannot end meanwhile
+    if is_cancelled():
+        os.killpg(0, KILL_SIGNAL)
+
+def _on_kill_signal(signum, frame):
+    pass
+
+class WorkerTask(object):
+    '''
+    Task sent to a worker process by a WorkerPool. Can be killed whether it is
+    still waiting in the worker or running.
+
+    :ivar _worker: Worker the task was sent to
+    :ivar _number: Number of the task
+    '''
+    def __init__(self, worker, number):
+        '''
+        Constructor.
+
+        :param worker: Worker the task was sent to
+        :type worker: Worker
+        :param number: Number of the task
+        :type number: int
+        '''
+        self._worker = worker
+        self._number = number
+
+    def kill(self):
+        '''
+        Terminates the commands the task is running and lets its function 
+        skip the rest of its work if it checks is_cancelled. Work done in the
+        worker process itself runs to the next check. The callback is still
+        invoked with whatever the function returns.
+        '''
+        self._worker.cancel(self._number)
+
+class Worker(object):
+    '''
+    Single worker process and the affinity keys of the jobs it ran lately.
+
+    :ivar process: multiprocessing.Process running tasks
+    :ivar conn: Server end of the connection tasks and results are sent over
+        or None once the process has exited
+    :ivar cancelled: Shared value holding the number of the task last 
+        cancelled
+    :ivar callbacks: Callbacks of the tasks sent to the process and not yet
+        done in the order they were sent
+    :ivar running: Number of tasks sent to the process and not yet done
+    :ivar warm: Affinity keys of recent tasks paired with the time they were
+        last sent
+    :ivar tasks: Number of tasks sent to the process
+    :ivar hits: Number of tasks sent while their key was warm
+    :ivar steals: Number of tasks sent while their key was warm on another
+        worker that was busier
+    '''
+    def __init__(self, inherited):
+        '''
+        Constructor. Forks the process.
+
+        :param inherited: Server ends of the connections to the workers
+            forked earlier
+        :type inherited: list
+        '''
+        self.conn, child = multiprocessing.Pipe()
+        self.cancelled = multiprocessing.RawValue('l', 0)
+        self.process = multiprocessing.Process(target=serve,
+            args=(child, inherited + [self.conn], self.cancelled))
+        self.process.daemon = True
+        self.process.start()
+        # only the worker holds its end so the server sees it exit
+        child.close()
+        self.callbacks = collections.deque()
+        self.running = 0
+        self.warm = {}
+        self.tasks = 0
+        self.hits = 0
+        self.steals = 0
+
+    def cancel(self, number):
+        '''
+        Cancels a task sent to the process. Only the task cancelled last is
+        remembered until the process gets to it.
+
+        :param number: Number of the task
+        :type number: int
+        '''
+        if self.conn is None:
+            return
+        self.cancelled.value = number
+        try:
+            os.kill(self.process.pid, CANCEL_SIGNAL)
+        except OSError:
+            # exited, the pool will notice
+            pass
+
+    def get_stats(self):
+        '''
+        :return: Counters describing the worker
+        :rtype: dict
+        '''
+        return {
+            'running' : self.running,
+            'tasks' : self.tasks,
+            'hits' : self.hits,
+            'steals' : self.steals,
+            'warm' : self.warm.keys()
+        }
+
+class WorkerPool(object):
+    '''
+    Pool of single process workers that routes tasks with the same affinity
+    key, such as the engine and voice of a synthesis job, to the worker that
+    ran them last so that the engine data they load stays warm in that
+    process and in the page cache. Only the least busy workers are
+    considered so that a task never queues behind a busy warm worker while
+    another worker is idle.
+
+    Every worker is forked when the pool is created and no threads are
+    started for them. The server sends tasks and reads results over pipes
+    watched by the IOLoop, so the pool must be created before any other
+    thread starts for the workers to inherit none. A killed task is 
+    cancelled by a signal to its worker, which terminates the commands it
+    runs for the task, since the worker is busy and not reading its pipe.
+
+    All methods must be called on the IOLoop thread. Callbacks are always
+    invoked on the IOLoop thread.
+
+    :ivar _workers: Worker objects whose processes are running
+    :ivar _numbers: Iterator over the numbers of new tasks
+    :cvar WARM_KEYS: Most affinity keys remembered per worker
+    '''
+    WARM_KEYS = 4
+
+    def __init__(self, processes):
+        '''
+        Constructor.
+
+        :param processes: Number of worker processes
+        :type processes: int
+        '''
+        self._workers = []
+        self._numbers = itertools.count(1)
+        for i in range(processes):
+            inherited = [worker.conn for worker in self._workers]
+            self._workers.append(Worker(inherited))
+        loop = tornado.ioloop.IOLoop.instance()
+        for worker in self._workers:
+            loop.add_handler(worker.conn.fileno(), functools.partial(
+                self._on_readable, worker), loop.READ | loop.ERROR)
+
+    def get_pids(self):
+        '''
+        :return: Process IDs of the running workers
+        :rtype: list
+        '''
+        return [worker.process.pid for worker in self._workers]
+
+    def is_warm(self, key):
+        '''
+        :param key: Affinity key
+        :type key: str
+        :return: True if a worker with no running tasks has run a task with
+            the key lately
+        :rtype: bool
+        '''
+        for worker in self._workers:
+            if not worker.running and key in worker.warm:
+                return True
+        return False
+
+    def apply_async(self, func, args, callback, key=None):
+        '''
+        Runs a function in the least busy worker, preferring among equally
+        busy workers the one that ran tasks with the same key most recently,
+        or else the one the key hashes to.
+
+        :param func: Function to run, importable by name in the workers
+        :type func: callable
+        :param args: Positional arguments for the function
+        :type args: tuple
+        :param callback: Invoked with the return value of the function or
+            None if the function raised an exception or the worker exited
+        :type callback: callable
+        :param key: Affinity key of the task or None if any worker will do
+        :type key: str
+        :return: Task that may be killed to cancel the work or None if no
+            worker is left to run it
+        :rtype: WorkerTask
+        '''
+        if not self._workers:
+            tornado.ioloop.IOLoop.instance().add_callback(
+                functools.partial(callback, None))
+            return None
+        worker = self._choose(key)
+        worker.running += 1
+        worker.tasks += 1
+        if key is not None:
+            if key in worker.warm:
+                worker.hits += 1
+            elif any(key in w.warm for w in self._workers):
+                worker.steals += 1
+            worker.warm[key] = time.time()
+            if len(worker.warm) > self.WARM_KEYS:
+                # forget the least recently used key
+                oldest = min(worker.warm, key=worker.warm.get)
+                del worker.warm[oldest]
+        number = self._numbers.next()
+        worker.callbacks.append(callback)
+        worker.conn.send((number, func, args))
+        return WorkerTask(worker, number)
+
+    def get_stats(self):
+        '''
+        :return: Counters describing each worker
+        :rtype: list
+        '''
+        return [worker.get_stats() for worker in self._workers]
+
+    def _choose(self, key):
+        least = min(worker.running for worker in self._workers)
+        idlest = [w for w in self._workers if w.running == least]
+        if key is None:
+            return idlest[0]
+        warm = [w for w in idlest if key in w.warm]
+        if warm:
+            return max(warm, key=lambda w: w.warm[key])
+        home = self._workers[hash(key) % len(self._workers)]
+        if home in idlest:
+            return home
+        return idlest[0]
+
+    def _on_readable(self, worker, fd, events):
+        try:
+            result = worker.conn.recv()
+        except (EOFError, IOError):
+            self._on_exit(worker)
+            return
+        worker.running -= 1
+        worker.callbacks.popleft()(result)
+
+    def _on_exit(self, worker):
+        # forking a replacement now would copy the threads of the server
+        logging.error('Worker process %d exited', worker.process.pid)
+        tornado.ioloop.IOLoop.instance().remove_handler(worker.conn.fileno())
+        worker.conn.close()
+        worker.conn = None
+        self._workers.remove(worker)
+        callbacks, worker.callbacks = worker.callbacks, collections.deque()
+        worker.running = 0
+        for callback in callbacks:
+            callback(None)